@@ -1 +1,3 @@
-from .chatgpt import ChatGPT, AsyncChatGPT
+from .chatgpt import ChatGPT, AsyncChatGPT, Conversation
+from .conversation_tree import ConversationTree
+from .errors import ChatGPTError, SessionUnusableError, UpstreamError, StreamTimeoutError, ResponseDecodeError, GenerationInterruptedError
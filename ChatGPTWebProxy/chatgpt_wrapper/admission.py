@@ -0,0 +1,195 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.errors import OverloadedError
+from chatgpt_wrapper.logger import Logger
+import chatgpt_wrapper.metrics as metrics
+
+def drain_time(queued, rate):
+    """
+    Seconds until queued requests have been admitted at rate per second,
+    used as the retry-after hint when rejecting a request.
+    """
+    return max(1, round((queued + 1) / (rate or 1)))
+
+class TokenBucket:
+    """
+    Admits requests at rate per second on average, with bursts of up to
+    burst requests. A rate of 0 admits everything.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class FairQueue:
+    """
+    Bounded weighted fair queue, keyed by client.
+
+    Items are tagged as in start-time fair queuing: a client's next item
+    starts where its previous one finished, or at the current virtual time
+    if the client was idle, and finishes 1 / weight later. Items are served
+    in order of finish tag, so a client flooding the queue only delays its
+    own items, while an occasional client is served within a round.
+    """
+
+    def __init__(self, max_size, max_per_client=None, weights=None, default_weight=1):
+        self.max_size = max_size
+        self.max_per_client = max_per_client
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.heap = []
+        self.counts = {}
+        self.finish = {}
+        self.vtime = 0
+        self.seq = itertools.count()
+        self.nonempty = asyncio.Event()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def full(self, client=None):
+        if len(self.heap) >= self.max_size:
+            return True
+        return bool(self.max_per_client) and self.counts.get(client, 0) >= self.max_per_client
+
+    def put_nowait(self, item, client=None):
+        """
+        Queue an item for a client. Returns False if the queue or the
+        client's share of it is full.
+        """
+        if self.full(client):
+            return False
+        weight = self.weights.get(client, self.default_weight)
+        start = max(self.vtime, self.finish.get(client, 0))
+        self.finish[client] = start + 1 / weight
+        heapq.heappush(self.heap, (self.finish[client], next(self.seq), start, client, item))
+        self.counts[client] = self.counts.get(client, 0) + 1
+        self.nonempty.set()
+        return True
+
+    def get_nowait(self):
+        _finish, _seq, start, client, item = heapq.heappop(self.heap)
+        self.vtime = start
+        self.counts[client] -= 1
+        if self.counts[client] == 0:
+            del self.counts[client]
+            if self.finish[client] <= self.vtime:
+                del self.finish[client]
+        if not self.heap:
+            self.nonempty.clear()
+        return item
+
+    async def get(self):
+        while not self.heap:
+            await self.nonempty.wait()
+        return self.get_nowait()
+
+class AdmissionController:
+    """
+    Admission layer for request handlers: a fair queue in front of a fixed
+    number of concurrent slots (the browser pages), with every admitted
+    request also taking a token from the upstream rate limit bucket.
+    Requests that do not fit in the queue are rejected right away with an
+    OverloadedError carrying a retry-after hint, unless they ask to wait for
+    room, as the items of a batch do.
+    """
+
+    def __init__(self, config=None, slots=1):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.bucket = TokenBucket(self.config.get('admission.rate'), self.config.get('admission.burst'))
+        self.queue = FairQueue(
+            self.config.get('admission.queue_size'),
+            self.config.get('admission.max_per_client'),
+            self.config.get('admission.weights'),
+        )
+        self.slots = slots
+        self.active = 0
+        self.room = asyncio.Event()
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.queue), queue="api")
+
+    def reject(self, client):
+        self.log.warning(f"Rejecting request from {client or 'anonymous client'}, queue is full")
+        metrics.REJECTIONS.inc()
+        raise OverloadedError(
+            "Too many requests queued, please try again later",
+            retry_after=drain_time(len(self.queue), self.bucket.rate),
+        )
+
+    def client_share(self):
+        """
+        How many requests a single client can have queued at once.
+        """
+        return self.queue.max_per_client or self.queue.max_size
+
+    def _dispatch(self):
+        while self.active < self.slots and len(self.queue):
+            ticket = self.queue.get_nowait()
+            self.room.set()
+            if ticket.done():
+                # Its request was cancelled while waiting.
+                continue
+            self.active += 1
+            ticket.set_result(None)
+
+    def release(self):
+        self.active -= 1
+        self._dispatch()
+
+    async def acquire(self, client=None, wait=False):
+        """
+        Wait for the client's turn and a free slot. Every acquire must be
+        followed by a release.
+
+        With wait set, a request that does not fit in the queue waits for
+        room instead of being rejected.
+
+        Raises:
+            OverloadedError: If the queue or the client's share of it is full.
+        """
+        ticket = asyncio.get_running_loop().create_future()
+        while not self.queue.put_nowait(ticket, client):
+            if not wait:
+                self.reject(client)
+            self.room.clear()
+            await self.room.wait()
+        self._dispatch()
+        start = time.monotonic()
+        try:
+            await ticket
+            await self.bucket.acquire()
+            metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - start, queue="api")
+        except asyncio.CancelledError:
+            if ticket.done() and not ticket.cancelled():
+                self.release()
+            raise
+
+    @asynccontextmanager
+    async def admit(self, client=None, wait=False):
+        await self.acquire(client, wait)
+        try:
+            yield
+        finally:
+            self.release()
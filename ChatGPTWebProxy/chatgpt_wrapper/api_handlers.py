@@ -0,0 +1,587 @@
+import asyncio
+import json
+
+from chatgpt_wrapper.admission import AdmissionController
+from chatgpt_wrapper.cache import ResponseCache
+from chatgpt_wrapper.chatgpt import Conversation
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.errors import ChatGPTError, DeadlineExceededError
+from chatgpt_wrapper.retry import RetryPolicy
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+def _valid_timeout(timeout):
+    return timeout is None or isinstance(timeout, (int, float)) and not isinstance(timeout, bool) and timeout > 0
+
+def parse_batch_items(body):
+    """
+    Normalize the prompts of a batch request into items with their own
+    new_conversation flag and timeout, None for no timeout. Returns None
+    for a malformed body.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("prompts"), list):
+        return None
+    default_new_conversation = body.get("new_conversation", True)
+    default_timeout = body.get("timeout")
+    items = []
+    for item in body["prompts"]:
+        if isinstance(item, str):
+            item = {"prompt": item}
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+            return None
+        item = {
+            "prompt": item["prompt"],
+            "new_conversation": item.get("new_conversation", default_new_conversation),
+            "timeout": item.get("timeout", default_timeout),
+        }
+        if not _valid_timeout(item["timeout"]):
+            return None
+        items.append(item)
+    return items
+
+async def ask_admitted(agpt, admission, retry, client, prompt, conversation, timeout=None):
+    """
+    Ask once the client has been admitted, retrying failed attempts. With a
+    timeout, a request still queued at its deadline is dropped and a
+    running one is interrupted.
+    """
+    async def admitted():
+        async with admission.admit(client):
+            return await retry.run(lambda: agpt.ask(prompt, conversation))
+    try:
+        return await asyncio.wait_for(admitted(), timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError(f"Timed out after {timeout} seconds")
+
+async def stream_admitted(agpt, admission, client, prompt, conversation, timeout=None):
+    """
+    Yield the response as it streams in, once the client has been admitted.
+    With a timeout, queueing included, DeadlineExceededError is raised past
+    it and the generation is interrupted.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout else None
+
+    def remaining():
+        return None if deadline is None else max(0, deadline - loop.time())
+
+    try:
+        await asyncio.wait_for(admission.acquire(client), remaining())
+    except asyncio.TimeoutError:
+        raise DeadlineExceededError(f"Timed out after {timeout} seconds")
+    stream = agpt.ask_stream(prompt, conversation)
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), remaining())
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise DeadlineExceededError(f"Timed out after {timeout} seconds")
+            yield chunk
+    finally:
+        await stream.aclose()
+        admission.release()
+
+async def ask_batch_item(agpt, cache, admission, retry, client, batch_slots, current_conversation, current_conversation_lock, index, item):
+    """
+    Answer one prompt of a batch. The batch is admitted as a unit: at most
+    batch_slots of its items are queued at once, and those wait for room in
+    the client's share of the queue rather than being rejected. The item's
+    timeout starts once it has been admitted.
+    """
+    async def answer(conversation):
+        async with batch_slots, admission.admit(client, wait=True):
+            return await asyncio.wait_for(retry.run(lambda: agpt.ask(item["prompt"], conversation)), item["timeout"])
+
+    result = {"index": index}
+    # Only prompts asked in a new conversation do not depend on earlier answers.
+    if item["new_conversation"]:
+        cached = cache.get(item["prompt"])
+        if cached is not None:
+            result.update({"success": True, "response": cached})
+            return result
+    try:
+        if item["new_conversation"]:
+            conversation = Conversation()
+            response = await answer(conversation)
+        else:
+            async with current_conversation_lock:
+                conversation = current_conversation
+                response = await answer(conversation)
+    except asyncio.TimeoutError:
+        result.update({"success": False, "error": f"Timed out after {item['timeout']} seconds"})
+        return result
+    except ChatGPTError as e:
+        result.update(chatgpt_error_response(e)[0])
+        return result
+    except Exception as e:
+        result.update({"success": False, "error": str(e)})
+        return result
+    if item["new_conversation"]:
+        cache.set(item["prompt"], response)
+    result.update({
+        "success": True,
+        "response": response,
+        "conversation_id": conversation.conversation_id,
+        "parent_message_id": conversation.parent_message_id,
+    })
+    return result
+
+def session_id_from_request(request):
+    """
+    The client session a request belongs to, from the X-Session-Id header
+    or the session_id query parameter. Requests without one share the
+    default conversation.
+    """
+    return request.headers.get("X-Session-Id") or request.args.get("session_id")
+
+def client_from_request(request):
+    """
+    The client a request is queued for by admission control: its session,
+    or its address for requests without one.
+    """
+    return session_id_from_request(request) or request.remote_addr
+
+def timeout_from_request(request):
+    timeout = request.args.get("timeout")
+    return float(timeout) if timeout else None
+
+def bypass_cache_from_request(request):
+    return request.args.get("nocache", "false").lower() in ("1", "true", "yes")
+
+def error_response(message, status=500):
+    return {"success": False, "error": str(message)}, status, {}
+
+def chatgpt_error_response(error):
+    """
+    The JSON body, status and headers to answer a ChatGPTError with.
+    """
+    headers = {}
+    body = {"success": False, "error": str(error), "retryable": error.retryable}
+    if error.retry_after:
+        headers["Retry-After"] = str(int(error.retry_after))
+        body["retry_after"] = error.retry_after
+    return body, error.http_status, headers
+
+def conversation_tree_response(tree, message_id=None):
+    """
+    The JSON body for a fetched conversation: the messages on the path to
+    message_id, defaulting to the active branch, and the alternative
+    branches at each message that has any. Returns None for an unknown
+    message_id.
+    """
+    if message_id and message_id not in tree:
+        return None
+    messages = tree.messages(message_id)
+    branches = {}
+    for message in messages:
+        siblings = tree.siblings(message["id"])
+        if len(siblings) > 1:
+            branches[message["id"]] = siblings
+    return {
+        "id": tree.conversation_id,
+        "title": tree.title,
+        "current_node": tree.current_node,
+        "messages": messages,
+        "branches": branches,
+    }
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_error_event(error):
+    """
+    The SSE error event ending a stream that failed. The response has
+    already started, so any error is reported this way.
+    """
+    if isinstance(error, ChatGPTError):
+        return sse_event("error", chatgpt_error_response(error)[0])
+    return sse_event("error", {"success": False, "error": str(error), "retryable": False})
+
+class ApiHandlers:
+    """
+    The routes of the HTTP API, independent of the web framework, so the
+    Flask (gpt_api) and Quart (gpt_async_api) applications serve exactly
+    the same API.
+
+    Handlers take the parts of the request they need and an AsyncChatGPT.
+    They are coroutines returning the body, status and headers of the
+    response, where a dict body is sent as JSON, or async generators
+    yielding the chunks of a streamed response.
+    """
+
+    def __init__(self, config=None, slots=1):
+        self.config = config or Config()
+        self.cache = ResponseCache(self.config)
+        self.retry = RetryPolicy(self.config)
+        self.admission = AdmissionController(self.config, slots)
+
+    async def ask(self, agpt, conversation, client, prompt, bypass_cache=False, timeout=None):
+        """
+        Ask a question.
+
+        Path:
+            POST /conversations
+
+        Headers:
+            X-Session-Id (str, optional): Client session whose conversation to continue.
+
+        Query Parameters:
+            nocache (bool, optional): Bypass the response cache (default is false).
+                The cache only answers prompts that start a conversation, and
+                a cached answer leaves the conversation unstarted.
+            session_id (str, optional): Same as the X-Session-Id header.
+            timeout (float, optional): Seconds to answer within, queueing included.
+
+        Request Body:
+            STRING:
+                Some text.
+
+        Returns:
+            STRING:
+                Some response.
+
+            JSON:
+                {
+                    "success": false,
+                    "error": "429 Too many requests",
+                    "retryable": true,
+                    "retry_after": 20
+                }
+
+            Failed attempts are retried with backoff first. The status is 429
+            when rate limited or when too many requests are queued, 503
+            without a usable session, 504 on a stream timeout or past the
+            timeout and 502 otherwise.
+        """
+        # Answers depend on the conversation so far, only a prompt starting
+        # one can be answered from the cache.
+        use_cache = not conversation.conversation_id
+        if use_cache and not bypass_cache:
+            result = self.cache.get(prompt)
+            if result is not None:
+                return result, 200, {}
+        try:
+            result = await ask_admitted(agpt, self.admission, self.retry, client, prompt, conversation, timeout)
+        except ChatGPTError as e:
+            return chatgpt_error_response(e)
+        if use_cache:
+            self.cache.set(prompt, result)
+        return result, 200, {}
+
+    async def ask_stream(self, agpt, conversation, client, prompt, timeout=None):
+        """
+        Ask a question, streaming the response as it is generated.
+
+        Path:
+            POST /conversations/stream
+
+        Headers:
+            X-Session-Id (str, optional): Client session whose conversation to continue.
+
+        Query Parameters:
+            timeout (float, optional): Seconds to answer within, queueing included.
+
+        Request Body:
+            STRING:
+                Some text.
+
+        Returns:
+            SSE:
+                event: chunk
+                data: "Some "
+
+                event: chunk
+                data: "response."
+
+                event: done
+                data: {"conversation_id": "abc123", "parent_message_id": "def456"}
+
+            A failed generation ends the stream with an error event instead
+            of done, its data as in the error response of /conversations.
+            If the client disconnects the generation is interrupted.
+        """
+        stream = stream_admitted(agpt, self.admission, client, prompt, conversation, timeout)
+        try:
+            async for chunk in stream:
+                yield sse_event("chunk", chunk)
+        except Exception as e:
+            yield stream_error_event(e)
+            return
+        finally:
+            await stream.aclose()
+        yield sse_event("done", {
+            "conversation_id": conversation.conversation_id,
+            "parent_message_id": conversation.parent_message_id,
+        })
+
+    async def ask_batch(self, agpt, conversation, client, items):
+        """
+        Ask several questions at once.
+
+        Prompts are scheduled across the available browser pages, and the
+        results are streamed back as newline-delimited JSON in completion
+        order, each tagged with the index of its prompt. Prompts that
+        continue the current conversation are sent one at a time, in order.
+
+        Path:
+            POST /conversations/batch
+
+        Request Body:
+            JSON:
+                {
+                    "prompts": [
+                        "Some text.",
+                        {
+                            "prompt": "Some other text.",
+                            "new_conversation": false,
+                            "timeout": 120
+                        }
+                    ],
+                    "new_conversation": true,
+                    "timeout": 60
+                }
+
+            timeout is in seconds per prompt, counted from when the prompt is
+            admitted; by default prompts have no timeout. The routes answer a
+            malformed body with an error, see parse_batch_items.
+
+        Returns:
+            NDJSON:
+                {"index": 1, "success": true, "response": "Some response.", "conversation_id": "abc123", "parent_message_id": "def456"}
+                {"index": 0, "success": false, "error": "Timed out after 60 seconds"}
+        """
+        current_conversation_lock = asyncio.Lock()
+        batch_slots = asyncio.Semaphore(self.admission.client_share())
+        tasks = [
+            asyncio.create_task(ask_batch_item(agpt, self.cache, self.admission, self.retry, client, batch_slots, conversation, current_conversation_lock, index, item))
+            for index, item in enumerate(items)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task) + "\n"
+        finally:
+            # The client went away, interrupt what is still running
+            # rather than leaving it to the next request on the loop.
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def new_conversation(self, agpt, session_id):
+        """
+        Start a new conversation.
+
+        Path:
+            POST /conversations/new
+
+        Headers:
+            X-Session-Id (str, optional): Client session to start the conversation for.
+
+        Returns:
+            JSON:
+                {
+                    "success": true,
+                    "parent_message_id": "def456"
+                }
+        """
+        conversation = agpt.new_conversation(session_id)
+        return {"success": True, "parent_message_id": conversation.parent_message_id}, 200, {}
+
+    async def get_conversation(self, agpt, conversation_id, message_id=None):
+        """
+        Retrieve the messages of a conversation.
+
+        Path:
+            GET /conversations/:conversation_id
+
+        Parameters:
+            conversation_id (str): The ID of the conversation to retrieve.
+
+        Query Parameters:
+            message_id (str, optional): Return the branch ending at this message
+                instead of the active one.
+
+        Returns:
+            JSON:
+                {
+                    "id": "abc123",
+                    "title": "Conversation Title",
+                    "current_node": "def456",
+                    "messages": [...],
+                    "branches": {
+                        ":message_id": [":message_id", ":sibling_id", ...],
+                    }
+                }
+
+            JSON:
+                {
+                    "success": false,
+                    "error": "Failed to get conversation"
+                }
+        """
+        tree = await agpt.get_conversation_tree(conversation_id)
+        result = tree and conversation_tree_response(tree, message_id)
+        if result:
+            return result, 200, {}
+        return error_response("Failed to get conversation")
+
+    async def switch_conversation(self, agpt, conversation_id, session_id, message_id=None):
+        """
+        Continue an existing conversation.
+
+        Path:
+            POST /conversations/:conversation_id/switch
+
+        Headers:
+            X-Session-Id (str, optional): Client session to switch.
+
+        Parameters:
+            conversation_id (str): The ID of the conversation to continue.
+
+        Query Parameters:
+            message_id (str, optional): Continue from this message instead of
+                the end of the active branch.
+
+        Returns:
+            JSON:
+                {
+                    "success": true,
+                    "conversation_id": "abc123",
+                    "parent_message_id": "def456"
+                }
+
+            JSON:
+                {
+                    "success": false,
+                    "error": "Failed to switch conversation"
+                }
+        """
+        tree = await agpt.get_conversation_tree(conversation_id)
+        if not tree or message_id and message_id not in tree:
+            return error_response("Failed to switch conversation")
+        conversation = agpt.switch_conversation(tree, session_id, message_id)
+        return {
+            "success": True,
+            "conversation_id": conversation.conversation_id,
+            "parent_message_id": conversation.parent_message_id,
+        }, 200, {}
+
+    async def delete_conversation(self, agpt, conversation_id):
+        """
+        Delete a conversation.
+
+        Path:
+            DELETE /conversations/:conversation_id
+
+        Parameters:
+            conversation_id (str): The ID of the conversation to delete.
+
+        Returns:
+            JSON:
+                {
+                    "success": true,
+                }
+
+            JSON:
+                {
+                    "success": false,
+                    "error": "Failed to delete conversation"
+                }
+        """
+        result = await agpt.delete_conversation(conversation_id)
+        if result:
+            return result, 200, {}
+        return error_response("Failed to delete conversation")
+
+    async def set_title(self, agpt, conversation_id, body):
+        """
+        Set the title of a conversation.
+
+        Path:
+            PATCH /conversations/:conversation_id/set-title
+
+        Parameters:
+            conversation_id (str): The ID of the conversation to set the title for.
+
+        Request Body:
+            JSON:
+                {
+                    "title": "New Title"
+                }
+
+        Returns:
+            JSON:
+                {
+                    "success": true,
+                }
+
+            JSON:
+                {
+                    "success": false,
+                    "error": "Failed to set title"
+                }
+        """
+        if not isinstance(body, dict) or not isinstance(body.get("title"), str):
+            return error_response("Request body must contain a title")
+        result = await agpt.set_title(body["title"], conversation_id=conversation_id)
+        if result:
+            return result, 200, {}
+        return error_response("Failed to set title")
+
+    async def get_history(self, agpt, limit=20, offset=0):
+        """
+        Retrieve conversation history.
+
+        Path:
+            GET /history
+
+        Query Parameters:
+            limit (int, optional): The maximum number of conversations to return (default is 20).
+            offset (int, optional): The number of conversations to skip before starting to return results (default is 0).
+
+        Returns:
+            JSON:
+                {
+                    ":conversation_id": {
+                        "id": "abc123",
+                        "title": "Conversation Title",
+                        ...
+                    },
+                    ...
+                }
+
+            JSON:
+                {
+                    "error": "Failed to get history"
+                }
+        """
+        result = await agpt.get_history(limit=limit, offset=offset)
+        if result:
+            return result, 200, {}
+        return error_response("Failed to get history")
+
+    def cache_stats(self):
+        """
+        Retrieve response cache statistics.
+
+        Path:
+            GET /cache
+
+        Returns:
+            JSON:
+                {
+                    "enabled": true,
+                    "entries": 42,
+                    "hits": 10,
+                    "misses": 32
+                }
+        """
+        return self.cache.stats(), 200, {}
+
+    def close(self):
+        self.cache.close()
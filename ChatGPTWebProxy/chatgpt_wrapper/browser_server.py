@@ -0,0 +1,41 @@
+import asyncio
+
+from playwright.async_api import async_playwright
+
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.logger import Logger
+
+async def serve(config=None):
+    """
+    Run a long-lived Chromium with the logged in profile and expose it over
+    the DevTools protocol, so AsyncChatGPT instances with browser.server
+    enabled can attach to it instead of launching and warming a browser on
+    every start.
+
+    Pages and the session survive restarts of the proxy, only a restart of
+    this process pays for a cold browser. The server has its own profile in
+    browser.server.user_data_dir, log in to it once with
+    `browser-server install`.
+    """
+    config = config or Config()
+    log = Logger("BrowserServer", config)
+    port = config.get('browser.server.port')
+    play = await async_playwright().start()
+    browser = await play.chromium.launch_persistent_context(
+        user_data_dir=config.get('browser.server.user_data_dir'),
+        headless=not config.get('browser.debug'),
+        args=[f"--remote-debugging-port={port}"],
+    )
+    base_url = config.get('chat.base_url').rstrip("/")
+    page = browser.pages[0] if len(browser.pages) > 0 else await browser.new_page()
+    await page.goto(f"{base_url}/")
+    for _ in range(1, config.get('browser.pages')):
+        extra_page = await browser.new_page()
+        await extra_page.goto(f"{base_url}/")
+    print(f"Browser server listening on http://127.0.0.1:{port}")
+    log.info(f"Browser server listening on port {port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await browser.close()
+        await play.stop()
@@ -0,0 +1,204 @@
+import os
+import time
+import datetime
+import hashlib
+import sqlite3
+from collections import OrderedDict
+
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.logger import Logger
+import chatgpt_wrapper.constants as constants
+import chatgpt_wrapper.metrics as metrics
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.split()).lower()
+
+def parse_timestamp(value):
+    """
+    Seconds since the epoch of a backend time, given either as epoch
+    seconds (conversation bodies) or as an ISO-8601 string in UTC (history
+    items). Returns None for a missing or unreadable time.
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        return parsed.timestamp()
+    return None
+
+class ResponseCache:
+    """
+    Persistent prompt -> response cache.
+
+    Entries are keyed on the normalized prompt plus the render model, stored
+    in a SQLite database in the data dir, expire after a TTL, and are
+    evicted least recently used first once the cache is full.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.enabled = self.config.get('cache.enabled')
+        self.ttl = self.config.get('cache.ttl')
+        self.max_entries = self.config.get('cache.max_entries')
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if self.enabled:
+            self._open(os.path.join(self.config.data_dir, self.config.get('cache.filename')))
+
+    def _open(self, filepath):
+        self.db = sqlite3.connect(filepath)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "response TEXT NOT NULL, "
+            "created REAL NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+        self.log.debug(f"Opened response cache at {filepath}")
+
+    def make_key(self, prompt, model=None):
+        model = constants.RENDER_MODELS[model or self.config.get('chat.model')]
+        return hashlib.sha256(f"{model}\0{normalize_prompt(prompt)}".encode("utf-8")).hexdigest()
+
+    def get(self, prompt, model=None):
+        if not self.enabled:
+            return None
+        key = self.make_key(prompt, model)
+        now = time.time()
+        row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            if row is not None:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+            self.misses += 1
+            metrics.CACHE_LOOKUPS.inc(result="miss")
+            return None
+        self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.db.commit()
+        self.hits += 1
+        metrics.CACHE_LOOKUPS.inc(result="hit")
+        return row[0]
+
+    def set(self, prompt, response, model=None):
+        if not self.enabled or not response:
+            return
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created, accessed) VALUES (?, ?, ?, ?)",
+            (self.make_key(prompt, model), response, now, now),
+        )
+        self._evict(now)
+        self.db.commit()
+
+    def _evict(self, now):
+        self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        self.db.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+    def clear(self):
+        if self.enabled:
+            self.db.execute("DELETE FROM responses")
+            self.db.commit()
+
+    def stats(self):
+        entries = 0
+        if self.enabled:
+            entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+class ConversationCache:
+    """
+    In-memory cache of history pages and conversation bodies.
+
+    History pages expire after history_ttl seconds, since conversations can
+    also change outside this client. Conversation bodies are kept until the
+    conversation changes: they are dropped when a fetched history page
+    lists the conversation with a different update_time, and when it is
+    renamed, deleted or asked something, which also drops the history pages.
+    At most max_conversations bodies are kept, least recently used first out.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.enabled = self.config.get('conversation_cache.enabled')
+        self.history_ttl = self.config.get('conversation_cache.history_ttl')
+        self.max_conversations = self.config.get('conversation_cache.max_conversations')
+        self.history = {}
+        self.conversations = OrderedDict()
+
+    def get_history(self, limit, offset):
+        if not self.enabled:
+            return None
+        entry = self.history.get((int(limit), int(offset)))
+        if entry is None or time.time() - entry[1] > self.history_ttl:
+            return None
+        return entry[0]
+
+    def set_history(self, limit, offset, history):
+        if not self.enabled:
+            return
+        self.history[(int(limit), int(offset))] = (history, time.time())
+        for conversation_id, item in history.items():
+            cached = self.conversations.get(conversation_id)
+            if cached is not None and self._changed(cached, item):
+                del self.conversations[conversation_id]
+
+    @staticmethod
+    def _changed(conversation_data, history_item):
+        # History items give ISO times, bodies epoch seconds. A time missing
+        # on either side cannot prove the body current, so it counts as
+        # changed.
+        cached = parse_timestamp(conversation_data.get("update_time"))
+        listed = parse_timestamp(history_item.get("update_time"))
+        if cached is None or listed is None:
+            return True
+        return abs(cached - listed) > 0.001
+
+    def get_conversation(self, conversation_id):
+        if not self.enabled or conversation_id not in self.conversations:
+            return None
+        self.conversations.move_to_end(conversation_id)
+        return self.conversations[conversation_id]
+
+    def set_conversation(self, conversation_id, conversation_data):
+        if not self.enabled:
+            return
+        self.conversations.pop(conversation_id, None)
+        self.conversations[conversation_id] = conversation_data
+        while len(self.conversations) > self.max_conversations:
+            self.conversations.popitem(last=False)
+
+    def invalidate(self, conversation_id=None):
+        """
+        Drop everything cached about a conversation that has changed,
+        including the history pages listing it.
+        """
+        self.history.clear()
+        if conversation_id is not None:
+            self.conversations.pop(conversation_id, None)
+
+    def clear(self):
+        self.history.clear()
+        self.conversations.clear()
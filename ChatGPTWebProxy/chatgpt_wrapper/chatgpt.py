@@ -1,22 +1,157 @@
+import os
 import platform
 import asyncio
+import datetime
 import signal
-import base64
 import json
-import time
 import uuid
 import re
 import shutil
+import time
+from collections import OrderedDict
 from typing import Optional
 from playwright.async_api import async_playwright
 from playwright._impl._api_structures import ProxySettings
 
+from chatgpt_wrapper.cache import ConversationCache, normalize_prompt
 from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.conversation_tree import ConversationTree
+from chatgpt_wrapper.errors import ChallengeError, GenerationInterruptedError, ResponseDecodeError, SessionUnusableError, StreamTimeoutError, UpstreamError
 from chatgpt_wrapper.logger import Logger
 import chatgpt_wrapper.constants as constants
+import chatgpt_wrapper.metrics as metrics
+from chatgpt_wrapper.tracing import get_tracer
+from chatgpt_wrapper.transport import HTTP_TRANSPORT_AVAILABLE, BrowserTransport, HttpTransport
 
 is_windows = platform.system() == "Windows"
 
+class ChatPage:
+    """
+    A browser tab in the AsyncChatGPT page pool.
+
+    Each tab has its own stream event queue, fed by the page binding, so
+    several generations can run side by side in the same browser context.
+    """
+
+    def __init__(self, page, index):
+        self.page = page
+        self.index = index
+        self.events = asyncio.Queue()
+        self.stream_id = None
+        self.streaming = False
+
+    def push_event(self, stream_id, kind, data):
+        self.events.put_nowait((stream_id, kind, data))
+
+class Conversation:
+    """
+    Cursor into a ChatGPT conversation: the conversation and the message
+    that the next prompt will be attached to.
+    """
+
+    def __init__(self, conversation_id=None, parent_message_id=None):
+        self.conversation_id = conversation_id
+        self.parent_message_id = parent_message_id or str(uuid.uuid4())
+        self.title_set = None
+        # The last prompt sent on this cursor, for callers that treat a
+        # repeated prompt as a request for a fresh conversation.
+        self.last_prompt = None
+
+    def branch(self):
+        """
+        Return a new cursor at the same point, so a prompt can be attached
+        there without moving this one.
+        """
+        conversation = Conversation(self.conversation_id, self.parent_message_id)
+        conversation.title_set = self.title_set
+        return conversation
+
+class ConversationStore:
+    """
+    Conversations keyed by a client-supplied session ID.
+
+    The store is bounded: sessions idle for longer than idle_timeout are
+    dropped, and the least recently used session is evicted once
+    max_sessions is reached.
+    """
+
+    def __init__(self, max_sessions, idle_timeout):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+
+    def _evict_idle(self, now):
+        while self.sessions:
+            session_id, (conversation, last_used) = next(iter(self.sessions.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self.sessions[session_id]
+
+    def get(self, session_id):
+        now = time.time()
+        self._evict_idle(now)
+        if session_id in self.sessions:
+            conversation = self.sessions.pop(session_id)[0]
+        else:
+            conversation = Conversation()
+            while len(self.sessions) >= self.max_sessions:
+                self.sessions.popitem(last=False)
+        self.sessions[session_id] = (conversation, now)
+        return conversation
+
+    def reset(self, session_id):
+        self.sessions.pop(session_id, None)
+        return self.get(session_id)
+
+    def conversations(self):
+        return [conversation for conversation, _last_used in self.sessions.values()]
+
+    def __len__(self):
+        return len(self.sessions)
+
+class InflightGeneration:
+    """
+    A generation shared by every caller that asked the same prompt at the
+    same point of a conversation while it was running. Chunks are recorded
+    so that late subscribers replay what they missed. Once every subscriber
+    has gone away the generation is cancelled.
+    """
+
+    def __init__(self, conversation):
+        self.conversation = conversation
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error=None):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            updated = self._updated
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await updated.wait()
+
 class AsyncChatGPT:
     """
     A ChatGPT interface that uses Playwright to run a browser,
@@ -24,30 +159,74 @@ class AsyncChatGPT:
     order to provide an open API to ChatGPT.
     """
 
-    stream_div_id = "chatgpt-wrapper-conversation-stream-data"
-    eof_div_id = "chatgpt-wrapper-conversation-stream-data-eof"
-    interrupt_div_id = "chatgpt-wrapper-conversation-stream-data-interrupt"
+    stream_binding = "chatgptWrapperStreamEvent"
+    stream_controller = "chatgptWrapperStreamController"
     session_div_id = "chatgpt-wrapper-session-data"
 
 
     def __init__(self, config=None):
         self.config = config or Config()
         self.log = Logger(self.__class__.__name__, self.config)
+        self.tracer = get_tracer(self.config)
         self.play = None
         self.user_data_dir = None
         self.page = None
+        self.pages = []
+        self.free_pages = None
         self.browser = None
-        self.parent_message_id = str(uuid.uuid4())
-        self.conversation_id = None
-        self.conversation_title_set = None
+        self.browser_server = None
+        self.transport = None
+        self.http_transport = None
+        # Tasks running a direct stream, mapped to whether they were asked
+        # to stop.
+        self.direct_streams = {}
+        self.conversation = Conversation()
+        self.sessions = ConversationStore(
+            self.config.get('chat.sessions.max'),
+            self.config.get('chat.sessions.idle_timeout'),
+        )
+        self.inflight = {}
+        self.conversation_cache = ConversationCache(self.config)
         self.model = self.config.get('chat.model')
+        self.base_url = self.config.get('chat.base_url').rstrip("/")
         self.session = None
-        self.streaming = None
+        self.session_page = None
+        self.session_task = None
+        self.session_file = os.path.join(self.config.data_dir, self.config.get('session.filename'))
 
-    async def create(self, timeout=60, proxy: Optional[ProxySettings] = None):
-        self.streaming = False
+    @property
+    def conversation_id(self):
+        return self.conversation.conversation_id
+
+    @conversation_id.setter
+    def conversation_id(self, value):
+        self.conversation.conversation_id = value
+
+    @property
+    def parent_message_id(self):
+        return self.conversation.parent_message_id
+
+    @parent_message_id.setter
+    def parent_message_id(self, value):
+        self.conversation.parent_message_id = value
+
+    @property
+    def conversation_title_set(self):
+        return self.conversation.title_set
+
+    @conversation_title_set.setter
+    def conversation_title_set(self, value):
+        self.conversation.title_set = value
+
+    async def create(self, timeout=60, proxy: Optional[ProxySettings] = None, copy_profile=False):
+        """
+        Start the browser and the session. With copy_profile the browser
+        runs on its own copy of the profile, so several instances, e.g. a
+        supervisor's active and standby browsers, can run side by side.
+        """
+        self.loop = asyncio.get_running_loop()
         self._setup_signal_handlers()
-        self.lock = asyncio.Lock()
+        self.session_lock = asyncio.Lock()
         self.play = await async_playwright().start()
         browser = self.config.get('browser.provider')
         headless = not self.config.get('browser.debug')
@@ -56,30 +235,99 @@ class AsyncChatGPT:
         except Exception:
             print(f"Browser {browser} is invalid, falling back on firefox")
             playbrowser = self.play.firefox
-        try:
-            self.browser = await playbrowser.launch_persistent_context(
-                user_data_dir="/tmp/playwright",
-                headless=headless,
-                proxy=proxy,
-            )
-        except Exception:
-            self.user_data_dir = f"/tmp/{str(uuid.uuid4())}"
-            shutil.copytree("/tmp/playwright", self.user_data_dir)
-            self.browser = await playbrowser.launch_persistent_context(
-                user_data_dir=self.user_data_dir,
-                headless=headless,
-                proxy=proxy,
-            )
+        if self.config.get('browser.server.enabled'):
+            await self._connect_browser_server()
+        if self.browser is None:
+            await self._launch_browser(playbrowser, headless, proxy, copy_profile)
 
         if len(self.browser.pages) > 0:
             self.page = self.browser.pages[0]
         else:
             self.page = await self.browser.new_page()
-        await self._start_browser()
+        await self._create_page_pool(self.config.get('browser.pages'))
+        self.transport = BrowserTransport(self.page.request)
         self.timeout = timeout
+        self._load_session()
+        await self._ensure_session()
+        await self._setup_http_transport()
+        self.session_task = asyncio.create_task(self._keep_session_fresh())
         self.log.info("ChatGPT initialized")
         return self
 
+    def _copy_profile(self):
+        # The profile may be in use by another browser, leave its locks
+        # behind, a dangling lock symlink would also fail the copy.
+        self.user_data_dir = f"/tmp/{str(uuid.uuid4())}"
+        shutil.copytree(
+            "/tmp/playwright",
+            self.user_data_dir,
+            ignore=shutil.ignore_patterns("lock", ".parentlock", "parent.lock", "Singleton*"),
+            ignore_dangling_symlinks=True,
+        )
+
+    async def _launch_browser(self, playbrowser, headless, proxy, copy_profile=False):
+        if not copy_profile:
+            try:
+                self.browser = await playbrowser.launch_persistent_context(
+                    user_data_dir="/tmp/playwright",
+                    headless=headless,
+                    proxy=proxy,
+                )
+                return
+            except Exception:
+                self.log.warning("Could not launch the browser on its profile, using a copy")
+        self._copy_profile()
+        self.browser = await playbrowser.launch_persistent_context(
+            user_data_dir=self.user_data_dir,
+            headless=headless,
+            proxy=proxy,
+        )
+
+    async def _connect_browser_server(self):
+        """
+        Attach to the persistent context of a running browser server (see
+        the `browser-server` command), reusing its already warmed pages.
+        Leaves self.browser unset if the server cannot be reached.
+        """
+        endpoint = self.config.get('browser.server.endpoint')
+        try:
+            self.browser_server = await self.play.chromium.connect_over_cdp(endpoint)
+            self.browser = self.browser_server.contexts[0]
+            self.log.info(f"Connected to browser server at {endpoint}")
+        except Exception as e:
+            self.log.warning(f"Could not connect to browser server at {endpoint}, launching a browser: {e}")
+            self.browser_server = None
+            self.browser = None
+
+    async def _setup_http_transport(self):
+        """
+        With transport.type 'http', send requests and streams directly over
+        HTTP with the browser's cookies, keeping the browser for session
+        refreshes and as a fallback when upstream challenges us.
+        """
+        if self.config.get('transport.type') != 'http':
+            return
+        if not HTTP_TRANSPORT_AVAILABLE:
+            self.log.warning("The http transport requires aiohttp, using the browser")
+            return
+        self.http_transport = HttpTransport(
+            self.base_url,
+            await self.page.evaluate("navigator.userAgent"),
+            self.config.get('transport.pool_size'),
+            self.config.get('transport.challenge_cooldown'),
+        )
+        await self._sync_transport_cookies()
+        self.log.info("Using the http transport")
+
+    async def _sync_transport_cookies(self):
+        if self.http_transport is not None:
+            self.http_transport.update_cookies(await self.browser.cookies(self.base_url))
+
+    def _direct_transport(self):
+        if self.http_transport is not None and self.http_transport.available():
+            return self.http_transport
+        return None
+
     def _setup_signal_handlers(self):
         sig = is_windows and signal.SIGBREAK or signal.SIGUSR1
         signal.signal(sig, self.terminate_stream)
@@ -88,36 +336,181 @@ class AsyncChatGPT:
         loop = asyncio.get_event_loop()
         loop.run_until_complete(asyncio.gather(self.cleanup()))
 
-    async def _start_browser(self):
-        await self.page.goto("https://chat.openai.com/")
+    async def _create_page_pool(self, size):
+        self.free_pages = asyncio.Queue()
+        self.pages = []
+        for index in range(max(1, size)):
+            if index == 0:
+                page = self.page
+            elif index < len(self.browser.pages):
+                page = self.browser.pages[index]
+            else:
+                page = await self.browser.new_page()
+            chat_page = ChatPage(page, index)
+            await page.expose_binding(
+                self.stream_binding,
+                lambda _source, stream_id, kind, data, chat_page=chat_page: chat_page.push_event(stream_id, kind, data),
+            )
+            await self._start_browser(page)
+            self.pages.append(chat_page)
+            self.free_pages.put_nowait(chat_page)
+        self.log.debug(f"Created page pool with {len(self.pages)} pages")
+
+    async def _checkout_page(self):
+        start = time.monotonic()
+        with self.tracer.span("checkout_page"):
+            chat_page = await self.free_pages.get()
+        metrics.PAGE_WAIT_SECONDS.observe(time.monotonic() - start)
+        return chat_page
+
+    def _release_page(self, chat_page):
+        self.free_pages.put_nowait(chat_page)
+
+    async def _start_browser(self, page=None):
+        page = page or self.page
+        if self.browser_server is not None and page.url.startswith(f"{self.base_url}/") and "/api/" not in page.url:
+            # Pages of a browser server are kept warm across restarts.
+            return
+        await page.goto(f"{self.base_url}/")
+
+    async def _ensure_session(self):
+        """
+        Fetch the session if there is none, without navigating any page of
+        the pool.
+        """
+        if self.session is not None:
+            return
+        async with self.session_lock:
+            if self.session is not None:
+                return
+            with self.tracer.span("fetch_session"):
+                await self._fetch_session()
+            await self._sync_transport_cookies()
+
+    async def _fetch_session(self):
+        """
+        Fetch /api/auth/session with a plain request sharing the browser's
+        cookies. If that gets a browser check instead of JSON, fall back to
+        navigating a dedicated session page, which is not part of the pool.
+        """
+        try:
+            response = await self.browser.request.get(f"{self.base_url}/api/auth/session")
+            if response.ok:
+                self._set_session(await response.json())
+                metrics.SESSION_REFRESHES.inc(method="request")
+                return
+        except Exception as e:
+            self.log.debug(f"Direct session request failed: {e}")
+        if self.session_page is None:
+            self.session_page = await self.browser.new_page()
+        with self.tracer.span("refresh_session"):
+            await self.refresh_session(page=self.session_page)
+
+    def _set_session(self, session):
+        self.session = session
+        self._save_session()
+
+    def _session_expires(self):
+        try:
+            return datetime.datetime.fromisoformat(self.session["expires"].replace("Z", "+00:00")).timestamp()
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _load_session(self):
+        if not self.config.get('session.persist'):
+            return
+        try:
+            with open(self.session_file, "r") as f:
+                self.session = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        expires = self._session_expires()
+        if "accessToken" not in self.session or expires is None or expires - time.time() < self.config.get('session.refresh_margin'):
+            self.log.debug("Stored session is unusable or about to expire")
+            self.session = None
+        else:
+            self.log.info("Loaded stored session")
+
+    def _save_session(self):
+        if not self.config.get('session.persist') or not self.session or "accessToken" not in self.session:
+            return
+        fd = os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.session, f)
+
+    def invalidate_session(self):
+        """
+        Drop the session after the backend rejected it, so the next
+        request fetches a new one.
+        """
+        self.log.info("Session rejected, invalidating")
+        self.session = None
+
+    async def _keep_session_fresh(self):
+        """
+        Background task refreshing the session shortly before it expires,
+        so requests never have to wait for a refresh.
+        """
+        margin = self.config.get('session.refresh_margin')
+        while True:
+            expires = self._session_expires() if self.session else None
+            delay = max(60, expires - time.time() - margin) if expires else 60
+            await asyncio.sleep(delay)
+            try:
+                with self.tracer.request("background_session_refresh"):
+                    async with self.session_lock:
+                        await self._fetch_session()
+                        await self._sync_transport_cookies()
+            except Exception as e:
+                self.log.error(f"Background session refresh failed: {e}")
 
     async def cleanup(self):
         self.log.info("Cleaning up")
+        if self.session_task is not None:
+            self.session_task.cancel()
+        if self.http_transport is not None:
+            await self.http_transport.close()
+        if self.browser_server is not None:
+            # Only disconnect, the browser server and its pool pages stay up.
+            # The session page was opened by us, close it or every restart
+            # leaves a tab behind.
+            if self.session_page is not None:
+                try:
+                    await self.session_page.close()
+                except Exception:
+                    self.log.warning("Failed to close the session page")
+                self.session_page = None
+            await self.browser_server.close()
+            await self.play.stop()
+            return
         await self.browser.close()
         # remove the user data dir in case this is a second instance
         if self.user_data_dir:
             shutil.rmtree(self.user_data_dir)
         await self.play.stop()
 
-    async def refresh_session(self, timeout=15):
+    async def refresh_session(self, timeout=15, page=None):
         """Refresh session, by redirecting the *page* to /api/auth/session rather than a simple xhr request.
 
         In this way, we can pass the browser check.
 
         Args:
             timeout (int, optional): Timeout waiting for the refresh in seconds. Defaults to 10.
+            page (Page, optional): The page to navigate. Defaults to the primary page.
         """
+        page = page or self.page
         self.log.info("Refreshing session...")
-        await self.page.goto("https://chat.openai.com/api/auth/session")
+        metrics.SESSION_REFRESHES.inc(method="page")
+        await page.goto(f"{self.base_url}/api/auth/session")
         try:
-            await self.page.wait_for_url("/api/auth/session", timeout=timeout * 1000)
+            await page.wait_for_url(f"{self.base_url}/api/auth/session", timeout=timeout * 1000)
         except Exception:
             self.log.error("Timed out refreshing session. Page is now at %s. Calling _start_browser()...")
-            await self._start_browser()
+            await self._start_browser(page)
         try:
-            while "Please stand by, while we are checking your browser..." in await self.page.content():
+            while "Please stand by, while we are checking your browser..." in await page.content():
                 await asyncio.sleep(1)
-            contents = await self.page.content()
+            contents = await page.content()
             """
             By GETting /api/auth/session, the server would ultimately return a raw json file.
             However, as this is a browser, it will add something to it, like <body> or so, like this:
@@ -132,26 +525,18 @@ class AsyncChatGPT:
                 raise json.JSONDecodeError("Cannot find JSON in /api/auth/session 's response", contents, 0)
             contents = contents[found_json.start():found_json.end()]
             self.log.debug("Refreshing session received: %s", contents)
-            self.session = json.loads(contents)
+            self._set_session(json.loads(contents))
             self.log.info("Succeessfully refreshed session. ")
         except json.JSONDecodeError:
             self.log.error("Failed to decode session key. Maybe Access denied? ")
 
         # Now the browser should be at /api/auth/session
         # Go back to the chat page.
-        await self._start_browser()
+        await self._start_browser(page)
 
-    async def _cleanup_divs(self):
-        await self.page.evaluate(f"document.getElementById('{self.stream_div_id}').remove()")
-        code = (
-            """
-            const eof_div = document.getElementById('EOF_DIV_ID');
-            if(typeof eof_div !== 'undefined' && eof_div !== null) {
-              eof_div.remove();
-            }
-            """
-        ).replace("EOF_DIV_ID", self.eof_div_id)
-        await self.page.evaluate(code)
+    async def _cleanup_stream(self, chat_page):
+        chat_page.stream_id = None
+        await chat_page.page.evaluate(f"delete window.{self.stream_controller}")
 
     def _api_request_build_headers(self, custom_headers={}):
         headers = {
@@ -170,86 +555,92 @@ class AsyncChatGPT:
                 pass
         if not response.ok or not json:
             self.log.debug(f"{response.status} {response.status_text} {response.headers}")
+        if response.status in (401, 403):
+            self.invalidate_session()
         return response.ok, json, response
 
-    async def _api_get_request(self, url, query_params={}, custom_headers={}):
+    async def _api_request(self, method, url, query_params=None, data=None, custom_headers={}):
         headers = self._api_request_build_headers(custom_headers)
-        response = await self.page.request.get(url, headers=headers, params=query_params)
-        return await self._process_api_response(url, response)
+        transport = self._direct_transport()
+        if transport is not None:
+            try:
+                response = await transport.request(method, url, headers=headers, params=query_params, data=data)
+                return await self._process_api_response(url, response, method=method)
+            except ChallengeError as e:
+                self.log.warning(f"{e}, falling back to the browser")
+        response = await self.transport.request(method, url, headers=headers, params=query_params, data=data)
+        return await self._process_api_response(url, response, method=method)
+
+    async def _api_get_request(self, url, query_params={}, custom_headers={}):
+        return await self._api_request("GET", url, query_params=query_params, custom_headers=custom_headers)
 
     async def _api_post_request(self, url, data={}, custom_headers={}):
-        headers = self._api_request_build_headers(custom_headers)
-        response = await self.page.request.post(url, headers=headers, data=data)
-        return await self._process_api_response(url, response, method="POST")
+        return await self._api_request("POST", url, data=data, custom_headers=custom_headers)
 
     async def _api_patch_request(self, url, data={}, custom_headers={}):
-        headers = self._api_request_build_headers(custom_headers)
-        response = await self.page.request.patch(url, headers=headers, data=data)
-        return await self._process_api_response(url, response, method="PATCH")
+        return await self._api_request("PATCH", url, data=data, custom_headers=custom_headers)
 
-    async def _gen_title(self):
-        if not self.conversation_id or self.conversation_id and self.conversation_title_set:
+    async def _gen_title(self, conversation=None):
+        conversation = conversation or self.conversation
+        if not conversation.conversation_id or conversation.conversation_id and conversation.title_set:
             return
-        url = f"https://chat.openai.com/backend-api/conversation/gen_title/{self.conversation_id}"
+        url = f"{self.base_url}/backend-api/conversation/gen_title/{conversation.conversation_id}"
         data = {
-            "message_id": self.parent_message_id,
+            "message_id": conversation.parent_message_id,
             "model": constants.RENDER_MODELS[self.model],
         }
         ok, json, response = await self._api_post_request(url, data)
         if ok:
             # TODO: Do we want to do anything with the title we got back?
             # response_data = response.json()
-            self.conversation_title_set = True
+            conversation.title_set = True
         else:
             self.log.warning("Failed to auto-generate title for new conversation")
 
     def conversation_data_to_messages(self, conversation_data):
-        mapping_dict = conversation_data['mapping']
-        messages = []
-        parent_id = None
-        while True:
-            current_item = next((item for item in mapping_dict.values() if item['parent'] == parent_id), None)
-            if current_item is None:
-                return messages
-            message = current_item['message']
-            if message is not None and 'author' in message and message['author']['role'] != 'system':
-                messages.append(current_item['message'])
-            parent_id = current_item['id']
+        return ConversationTree(conversation_data).messages()
 
     async def delete_conversation(self, uuid=None):
-        if self.session is None:
-            await self.refresh_session()
+        await self._ensure_session()
         if not uuid and not self.conversation_id:
             return
         id = uuid if uuid else self.conversation_id
-        url = f"https://chat.openai.com/backend-api/conversation/{id}"
+        url = f"{self.base_url}/backend-api/conversation/{id}"
         data = {
             "is_visible": False,
         }
         ok, json, response = await self._api_patch_request(url, data)
+        self.conversation_cache.invalidate(id)
         if ok:
             return json
         else:
             self.log.error("Failed to delete conversation")
 
     async def set_title(self, title, conversation_id=None):
-        if self.session is None:
-            await self.refresh_session()
+        await self._ensure_session()
         id = conversation_id if conversation_id else self.conversation_id
-        url = f"https://chat.openai.com/backend-api/conversation/{id}"
+        url = f"{self.base_url}/backend-api/conversation/{id}"
         data = {
             "title": title,
         }
         ok, json, response = await self._api_patch_request(url, data)
+        self.conversation_cache.invalidate(id)
         if ok:
             return json
         else:
             self.log.error("Failed to set title")
 
-    async def get_history(self, limit=20, offset=0):
-        if self.session is None:
-            await self.refresh_session()
-        url = "https://chat.openai.com/backend-api/conversations"
+    async def get_history(self, limit=20, offset=0, refresh=False):
+        """
+        Fetch a page of the conversation history, from the conversation
+        cache unless refresh is set.
+        """
+        if not refresh:
+            history = self.conversation_cache.get_history(limit, offset)
+            if history is not None:
+                return history
+        await self._ensure_session()
+        url = f"{self.base_url}/backend-api/conversations"
         query_params = {
             "offset": offset,
             "limit": limit,
@@ -259,35 +650,94 @@ class AsyncChatGPT:
             history = {}
             for item in json["items"]:
                 history[item["id"]] = item
+            self.conversation_cache.set_history(limit, offset, history)
             return history
         else:
             self.log.error("Failed to get history")
 
     async def get_conversation(self, uuid=None):
-        if self.session is None:
-            await self.refresh_session()
         uuid = uuid if uuid else self.conversation_id
         if uuid:
-            url = f"https://chat.openai.com/backend-api/conversation/{uuid}"
+            conversation_data = self.conversation_cache.get_conversation(uuid)
+            if conversation_data is not None:
+                return conversation_data
+            await self._ensure_session()
+            url = f"{self.base_url}/backend-api/conversation/{uuid}"
             ok, json, response = await self._api_get_request(url)
             if ok:
+                self.conversation_cache.set_conversation(uuid, json)
                 return json
             else:
                 self.log.error(f"Failed to get conversation {uuid}")
 
-    async def ask_stream(self, prompt: str):
-        if self.session is None:
-            await self.refresh_session()
+    async def get_conversation_tree(self, uuid=None):
+        conversation_data = await self.get_conversation(uuid)
+        if conversation_data:
+            return ConversationTree(conversation_data)
+
+    async def ask_stream(self, prompt: str, conversation=None):
+        """
+        Send a message to chatGPT and yield the response as it streams in.
+
+        Identical prompts sent at the same point of a conversation while a
+        generation is running attach to it instead of starting another one.
+
+        Args:
+            prompt (str): The message to send.
+            conversation (Conversation, optional): Where to attach the message.
+                Defaults to the current conversation.
+        """
+        conversation = conversation or self.conversation
+        key = (normalize_prompt(prompt), conversation.conversation_id, conversation.parent_message_id)
+        generation = self.inflight.get(key)
+        if generation is None:
+            generation = InflightGeneration(conversation)
+            self.inflight[key] = generation
+            generation.task = asyncio.create_task(self._run_generation(key, generation, prompt))
+        else:
+            self.log.info("Attaching to in-flight generation of the same prompt")
+        generation.subscribers += 1
+        try:
+            async for chunk in generation.subscribe():
+                yield chunk
+        finally:
+            generation.subscribers -= 1
+            if generation.subscribers == 0 and not generation.done:
+                # Nobody is left to read the response, free the page.
+                self.log.info("All callers went away, cancelling generation")
+                if self.inflight.get(key) is generation:
+                    del self.inflight[key]
+                generation.task.cancel()
+        if conversation is not generation.conversation:
+            conversation.conversation_id = generation.conversation.conversation_id
+            conversation.parent_message_id = generation.conversation.parent_message_id
+            conversation.title_set = generation.conversation.title_set
+
+    async def _run_generation(self, key, generation, prompt):
+        error = None
+        try:
+            with self.tracer.span("generation"):
+                async for chunk in self._ask_stream(prompt, generation.conversation):
+                    generation.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            self.conversation_cache.invalidate(generation.conversation.conversation_id)
+            if self.inflight.get(key) is generation:
+                del self.inflight[key]
+            generation.finish(error)
+
+    async def _ask_stream(self, prompt, conversation):
+        await self._ensure_session()
 
         new_message_id = str(uuid.uuid4())
 
         if "accessToken" not in self.session:
-            yield (
+            raise SessionUnusableError(
                 "Your ChatGPT session is not usable.\n"
                 "* Run this program with the `install` parameter and log in to ChatGPT.\n"
                 "* If you think you are already logged in, try running the `session` command."
             )
-            return
 
         request = {
             "messages": [
@@ -298,166 +748,336 @@ class AsyncChatGPT:
                 }
             ],
             "model": constants.RENDER_MODELS[self.model],
-            "conversation_id": self.conversation_id,
-            "parent_message_id": self.parent_message_id,
+            "conversation_id": conversation.conversation_id,
+            "parent_message_id": conversation.parent_message_id,
             "action": "next",
         }
 
+        if self._direct_transport() is not None:
+            try:
+                async for chunk in self._stream_direct(request, conversation):
+                    yield chunk
+                with self.tracer.span("gen_title"):
+                    await self._gen_title(conversation)
+                return
+            except ChallengeError as e:
+                self.log.warning(f"{e}, falling back to the browser")
+
         code = (
             """
-            const stream_div = document.createElement('DIV');
-            stream_div.id = "STREAM_DIV_ID";
-            document.body.appendChild(stream_div);
-            const xhr = new XMLHttpRequest();
-            xhr.open('POST', 'https://chat.openai.com/backend-api/conversation');
-            xhr.setRequestHeader('Accept', 'text/event-stream');
-            xhr.setRequestHeader('Content-Type', 'application/json');
-            xhr.setRequestHeader('Authorization', 'Bearer BEARER_TOKEN');
-            xhr.responseType = 'stream';
-            xhr.onreadystatechange = function() {
-              var newEvent;
-              const interrupt_div = document.getElementById('INTERRUPT_DIV_ID');
-              if(xhr.readyState == 3 || xhr.readyState == 4) {
-                const newData = xhr.response.substr(xhr.seenBytes);
-                try {
-                  const newEvents = newData.split(/\\n\\n/).reverse();
-                  newEvents.shift();
-                  if(newEvents[0] == "data: [DONE]") {
-                    newEvents.shift();
+            const stream_id = "STREAM_ID";
+            const controller = new AbortController();
+            window.STREAM_CONTROLLER = controller;
+            const emit = (kind, data) => window.STREAM_BINDING(stream_id, kind, data);
+            (async () => {
+              try {
+                const response = await fetch('BASE_URL/backend-api/conversation', {
+                  method: 'POST',
+                  headers: {
+                    'Accept': 'text/event-stream',
+                    'Content-Type': 'application/json',
+                    'Authorization': 'Bearer BEARER_TOKEN',
+                  },
+                  body: JSON.stringify(REQUEST_JSON),
+                  signal: controller.signal,
+                });
+                if(!response.ok) {
+                  emit('error', JSON.stringify({
+                    status: response.status,
+                    retry_after: response.headers.get('retry-after'),
+                    message: await response.text(),
+                  }));
+                  return;
+                }
+                // Incremental server-sent-events parser: every complete event
+                // is forwarded exactly once, as soon as its blank line arrives.
+                const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+                let buffer = '';
+                let dataLines = [];
+                // Upstream events carry the whole message so far; only the new
+                // suffix is forwarded, and the ids only when they change.
+                let lastMessage = '';
+                let lastMeta = null;
+                const forward = (data) => {
+                  let event, meta, message;
+                  try {
+                    event = JSON.parse(data);
+                    meta = JSON.stringify({
+                      conversation_id: event.conversation_id,
+                      message_id: event.message.id,
+                    });
+                    message = event.message.content.parts.join('\\n');
+                  } catch (err) {
+                    err.decode = true;
+                    throw err;
+                  }
+                  if(meta !== lastMeta) {
+                    lastMeta = meta;
+                    emit('meta', meta);
+                  }
+                  const delta = message.substring(lastMessage.length);
+                  lastMessage = message;
+                  if(delta !== '') {
+                    emit('delta', delta);
                   }
-                  if(newEvents.length > 0) {
-                    newEvent = newEvents[0].substring(6);
-                    // using XHR for eventstream sucks and occasionally ive seen incomplete
-                    // json objects come through  JSON.parse will throw if that happens, and
-                    // that should just skip until we get a full response.
-                    JSON.parse(newEvent);
+                };
+                while(true) {
+                  const {value, done} = await reader.read();
+                  if(done) {
+                    break;
+                  }
+                  buffer += value;
+                  const lines = buffer.split('\\n');
+                  buffer = lines.pop();
+                  for(let line of lines) {
+                    line = line.replace(/\\r$/, '');
+                    if(line === '') {
+                      const data = dataLines.join('\\n');
+                      dataLines = [];
+                      if(data !== '' && data !== '[DONE]') {
+                        forward(data);
+                      }
+                    } else if(line.startsWith('data:')) {
+                      dataLines.push(line.substring(line.startsWith('data: ') ? 6 : 5));
+                    }
                   }
-                } catch (err) {
-                  console.log(err);
-                  newEvent = undefined;
                 }
-                if(newEvent !== undefined) {
-                  stream_div.innerHTML = btoa(newEvent);
-                  xhr.seenBytes = xhr.responseText.length;
+              } catch (err) {
+                if(err.name !== 'AbortError') {
+                  emit('error', JSON.stringify({
+                    status: null,
+                    decode: err.decode === true,
+                    message: String(err),
+                  }));
                 }
+              } finally {
+                emit('eof', null);
               }
-              if(xhr.readyState == 4 && (typeof interrupt_div === 'undefined' || interrupt_div === null)) {
-                const eof_div = document.createElement('DIV');
-                eof_div.id = "EOF_DIV_ID";
-                document.body.appendChild(eof_div);
-              }
-              if(typeof interrupt_div !== 'undefined' && interrupt_div !== null) {
-                console.warn('Interrupting stream');
-                xhr.abort();
-                interrupt_div.remove();
-              }
-            };
-            xhr.send(JSON.stringify(REQUEST_JSON));
+            })();
             """.replace(
                 "BEARER_TOKEN", self.session["accessToken"]
             )
             .replace("REQUEST_JSON", json.dumps(request))
-            .replace("STREAM_DIV_ID", self.stream_div_id)
-            .replace("EOF_DIV_ID", self.eof_div_id)
-            .replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
+            .replace("BASE_URL", self.base_url)
         )
 
-        self.streaming = True
-        await self.page.evaluate(code)
-
-        last_event_msg = ""
-        start_time = time.time()
-        while True:
-            if not self.streaming:
-                self.log.info("Request to interrupt streaming")
-                await self.interrupt_stream()
-                break
-            eof_datas = await self.page.query_selector_all(f"div#{self.eof_div_id}")
+        chat_page = await self._checkout_page()
+        try:
+            async for chunk in self._stream_on_page(chat_page, code, conversation):
+                yield chunk
+        finally:
+            self._release_page(chat_page)
+        with self.tracer.span("gen_title"):
+            await self._gen_title(conversation)
 
-            conversation_datas = await self.page.query_selector_all(
-                f"div#{self.stream_div_id}"
-            )
-            if len(conversation_datas) == 0:
-                continue
+    async def _stream_direct(self, request, conversation):
+        """
+        Stream a conversation request over the http transport. Raises
+        ChallengeError before anything is yielded if the browser is needed.
+        """
+        start = time.monotonic()
+        first_chunk = True
+        events = 0
+        task = asyncio.current_task()
+        self.direct_streams[task] = False
+        try:
+            with self.tracer.span("http.stream"):
+                stream = self.http_transport.stream(
+                    f"{self.base_url}/backend-api/conversation",
+                    request,
+                    self._api_request_build_headers({"Content-Type": "application/json"}),
+                    self.timeout,
+                )
+                async for kind, data in stream:
+                    events += 1
+                    if kind == "delta":
+                        if first_chunk:
+                            metrics.FIRST_CHUNK_SECONDS.observe(time.monotonic() - start)
+                            first_chunk = False
+                        yield data
+                    elif kind == "error":
+                        raise self._stream_error(data)
+                    elif kind == "meta":
+                        meta = json.loads(data)
+                        conversation.parent_message_id = meta["message_id"]
+                        conversation.conversation_id = meta["conversation_id"]
+        except asyncio.CancelledError:
+            if not self.direct_streams.get(task):
+                raise
+            # Cancelled by terminate_stream rather than by our caller.
+            if hasattr(task, "uncancel"):
+                task.uncancel()
+            raise GenerationInterruptedError("Generation stopped")
+        finally:
+            self.direct_streams.pop(task, None)
+            metrics.GENERATION_SECONDS.observe(time.monotonic() - start)
+            metrics.STREAM_EVENTS.observe(events)
 
-            full_event_message = None
+    async def _stream_on_page(self, chat_page, code, conversation):
+        chat_page.stream_id = str(uuid.uuid4())
+        code = (
+            code.replace("STREAM_ID", chat_page.stream_id)
+            .replace("STREAM_CONTROLLER", self.stream_controller)
+            .replace("STREAM_BINDING", self.stream_binding)
+        )
+        # Drop anything left behind by an earlier, interrupted stream.
+        while not chat_page.events.empty():
+            chat_page.events.get_nowait()
 
-            try:
-                event_raw = base64.b64decode(await conversation_datas[0].inner_html())
-                if len(event_raw) > 0:
-                    event = json.loads(event_raw)
-                    if event is not None:
-                        self.parent_message_id = event["message"]["id"]
-                        self.conversation_id = event["conversation_id"]
-                        full_event_message = "\n".join(
-                            event["message"]["content"]["parts"]
-                        )
-            except Exception:
-                yield (
-                    "Failed to read response from ChatGPT.  Tips:\n"
-                    " * Try again.  ChatGPT can be flaky.\n"
-                    " * Use the `session` command to refresh your session, and then try again.\n"
-                    " * Restart the program in the `install` mode and make sure you are logged in."
-                )
-                break
+        chat_page.streaming = True
+        start = time.monotonic()
+        first_chunk = True
+        events = 0
+        with self.tracer.span("page.evaluate", page=chat_page.index):
+            await chat_page.page.evaluate(code)
 
-            if full_event_message is not None:
-                chunk = full_event_message[len(last_event_msg):]
-                last_event_msg = full_event_message
-                yield chunk
+        try:
+            with self.tracer.span("stream.wait", page=chat_page.index):
+                while True:
+                    try:
+                        stream_id, kind, data = await asyncio.wait_for(chat_page.events.get(), self.timeout)
+                        events += 1
+                    except asyncio.TimeoutError:
+                        self.log.error(f"No stream event received in {self.timeout} seconds")
+                        await self.interrupt_stream(chat_page)
+                        raise StreamTimeoutError(f"No stream event received in {self.timeout} seconds")
+                    if kind == "interrupt" or not chat_page.streaming:
+                        self.log.info("Request to interrupt streaming")
+                        await self.interrupt_stream(chat_page)
+                        break
+                    if stream_id != chat_page.stream_id:
+                        continue
+                    # the eof signal is sent after the last event, so we are done
+                    if kind == "eof":
+                        break
+                    if kind == "delta":
+                        if first_chunk:
+                            metrics.FIRST_CHUNK_SECONDS.observe(time.monotonic() - start)
+                            first_chunk = False
+                        yield data
+                        continue
+                    if kind == "error":
+                        raise self._stream_error(data)
 
-            # if we saw the eof signal, this was the last event we
-            # should process and we are done
-            if len(eof_datas) > 0 or (((time.time() - start_time) > self.timeout) and full_event_message is None):
-                break
+                    try:
+                        meta = json.loads(data)
+                        conversation.parent_message_id = meta["message_id"]
+                        conversation.conversation_id = meta["conversation_id"]
+                    except (ValueError, KeyError, TypeError) as e:
+                        self.log.error(f"Failed to read stream event: {e}")
+                        raise ResponseDecodeError(f"Failed to read response from ChatGPT: {e}")
 
-            await asyncio.sleep(0.2)
+            if not chat_page.streaming:
+                raise GenerationInterruptedError("Generation stopped")
+        except asyncio.CancelledError:
+            # Stop the fetch running in the page, not just our reading of it.
+            await self.interrupt_stream(chat_page)
+            raise
+        finally:
+            metrics.GENERATION_SECONDS.observe(time.monotonic() - start)
+            metrics.STREAM_EVENTS.observe(events)
+            chat_page.streaming = False
+            with self.tracer.span("cleanup_stream", page=chat_page.index):
+                await self._cleanup_stream(chat_page)
 
-        if not self.streaming:
-            yield (
-                "\nGeneration stopped\n"
-            )
-        self.streaming = False
-        await self._cleanup_divs()
-        await self._gen_title()
+    def _stream_error(self, data):
+        """
+        Classify an error reported by the in-page stream.
+        """
+        try:
+            error = json.loads(data)
+        except ValueError:
+            return ResponseDecodeError(f"Failed to read response from ChatGPT: {data}")
+        status = error.get("status")
+        message = error.get("message") or ""
+        self.log.error(f"Stream failed: {status} {message}")
+        if status in (401, 403):
+            self.invalidate_session()
+            return SessionUnusableError(f"Session rejected by ChatGPT: {status} {message}", retryable=True)
+        if error.get("decode"):
+            return ResponseDecodeError(f"Failed to read response from ChatGPT: {message}")
+        try:
+            retry_after = float(error.get("retry_after"))
+        except (TypeError, ValueError):
+            retry_after = None
+        return UpstreamError(status, f"{status} {message}" if status else message, retry_after)
 
-    async def interrupt_stream(self):
-        self.log.info("Interrupting stream")
-        code = (
-            """
-            const interrupt_div = document.createElement('DIV');
-            interrupt_div.id = "INTERRUPT_DIV_ID";
-            document.body.appendChild(interrupt_div);
-            """
-        ).replace("INTERRUPT_DIV_ID", self.interrupt_div_id)
-        await self.page.evaluate(code)
+    async def interrupt_stream(self, chat_page=None):
+        """
+        Interrupt the stream running on the given page, or on every page
+        of the pool that is currently streaming.
+        """
+        chat_pages = [chat_page] if chat_page else [p for p in self.pages if p.streaming]
+        for chat_page in chat_pages:
+            self.log.info(f"Interrupting stream on page {chat_page.index}")
+            chat_page.streaming = False
+            code = (
+                """
+                const controller = window.STREAM_CONTROLLER;
+                if(typeof controller !== 'undefined' && controller !== null) {
+                  console.warn('Interrupting stream');
+                  controller.abort();
+                }
+                """
+            ).replace("STREAM_CONTROLLER", self.stream_controller)
+            await chat_page.page.evaluate(code)
 
     def terminate_stream(self, _signal, _frame):
         self.log.info("Received signal to terminate stream")
-        if self.streaming:
-            self.streaming = False
+        for chat_page in self.pages:
+            if chat_page.streaming:
+                chat_page.streaming = False
+                self.loop.call_soon_threadsafe(chat_page.push_event, None, "interrupt", None)
+        for task, interrupted in list(self.direct_streams.items()):
+            if not interrupted:
+                self.direct_streams[task] = True
+                self.loop.call_soon_threadsafe(task.cancel)
 
-    async def ask(self, message: str) -> str:
+    async def ask(self, message: str, conversation=None) -> str:
         """
         Send a message to chatGPT and return the response.
 
         Args:
             message (str): The message to send.
+            conversation (Conversation, optional): Where to attach the message.
+                Defaults to the current conversation.
 
         Returns:
             str: The response received from OpenAI.
+
+        Raises:
+            ChatGPTError: If no response could be produced.
         """
-        async with self.lock:
-            response = list([i async for i in self.ask_stream(message)])
-            if len(response) == 0:
-                return "Unusable response produced, maybe login session expired. Try 'pkill firefox' and 'chatgpt install'"
-            else:
-                return ''.join(response)
+        response = list([i async for i in self.ask_stream(message, conversation)])
+        if len(response) == 0:
+            raise ResponseDecodeError("Unusable response produced, maybe login session expired. Try 'pkill firefox' and 'chatgpt install'")
+        return ''.join(response)
+
+    def get_session(self, session_id=None):
+        """
+        Return the conversation of a client session, or the current
+        conversation if no session ID is given.
+        """
+        if session_id is None:
+            return self.conversation
+        return self.sessions.get(session_id)
 
-    def new_conversation(self):
-        self.parent_message_id = str(uuid.uuid4())
-        self.conversation_id = None
-        self.conversation_title_set = None
+    def new_conversation(self, session_id=None):
+        if session_id is None:
+            self.conversation = Conversation()
+            return self.conversation
+        return self.sessions.reset(session_id)
+
+    def switch_conversation(self, tree, session_id=None, message_id=None):
+        """
+        Continue a fetched conversation from message_id, defaulting to the
+        end of its active branch.
+        """
+        conversation = self.new_conversation(session_id)
+        conversation.conversation_id = tree.conversation_id
+        conversation.parent_message_id = message_id or tree.current_node
+        conversation.title_set = True
+        return conversation
 
 class ChatGPT:
 
@@ -479,7 +1099,7 @@ class ChatGPT:
     def refresh_session(self):
         return self.async_run(self.agpt.refresh_session())
 
-    def ask_stream(self, prompt: str):
+    def ask_stream(self, prompt: str, conversation=None):
         def iter_over_async(ait):
             loop = asyncio.get_event_loop()
             ait = ait.__aiter__()
@@ -489,27 +1109,34 @@ class ChatGPT:
                     return False, obj
                 except StopAsyncIteration:
                     return True, None
-            while True:
-                done, obj = loop.run_until_complete(get_next())
-                if done:
-                    break
-                yield obj
-        yield from iter_over_async(self.agpt.ask_stream(prompt))
+            try:
+                while True:
+                    done, obj = loop.run_until_complete(get_next())
+                    if done:
+                        break
+                    yield obj
+            finally:
+                # Closed early, e.g. the HTTP client disconnected.
+                loop.run_until_complete(ait.aclose())
+        yield from iter_over_async(self.agpt.ask_stream(prompt, conversation))
 
-    def ask(self, message: str) -> str:
-        return self.async_run(self.agpt.ask(message))
+    def ask(self, message: str, conversation=None) -> str:
+        return self.async_run(self.agpt.ask(message, conversation))
 
     def get_conversation(self, uuid=None):
         return self.async_run(self.agpt.get_conversation(uuid))
 
+    def get_conversation_tree(self, uuid=None):
+        return self.async_run(self.agpt.get_conversation_tree(uuid))
+
     def delete_conversation(self, uuid=None):
         return self.async_run(self.agpt.delete_conversation(uuid))
 
     def set_title(self, title, conversation_id=None):
         return self.async_run(self.agpt.set_title(title, conversation_id))
 
-    def get_history(self, limit=20, offset=0):
-        return self.async_run(self.agpt.get_history(limit, offset))
+    def get_history(self, limit=20, offset=0, refresh=False):
+        return self.async_run(self.agpt.get_history(limit, offset, refresh))
 
     def __del__(self):
         self.async_run(self.agpt.cleanup())
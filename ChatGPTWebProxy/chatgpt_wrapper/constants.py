@@ -9,6 +9,8 @@ RENDER_MODELS = {
     "legacy-free": "text-davinci-002-render"
 }
 
+DEFAULT_BASE_URL = "https://chat.openai.com"
+
 # Config specific constants.
 DEFAULT_PROFILE = 'default'
 DEFAULT_CONFIG_DIR = 'chatgpt-wrapper'
@@ -16,10 +18,26 @@ DEFAULT_CONFIG = {
     'browser': {
         'provider': 'firefox',
         'debug': False,
+        'pages': 1,
+        'standby': True,
+        'server': {
+            'enabled': False,
+            'port': 9222,
+            'endpoint': 'http://127.0.0.1:9222',
+            # Chromium profile of the browser server, separate from the
+            # profile 'install' creates for browser.provider.
+            'user_data_dir': os.path.join(tempfile.gettempdir(), 'playwright-server'),
+        },
     },
     'chat': {
+        # Where ChatGPT is served, e.g. a local fake_server for testing.
+        'base_url': DEFAULT_BASE_URL,
         'model': 'default',
         'streaming': True,
+        'sessions': {
+            'max': 1000,
+            'idle_timeout': 60 * 60,
+        },
         'log': {
             'enabled': False,
             'filepath': 'chatgpt.log',
@@ -31,6 +49,81 @@ DEFAULT_CONFIG = {
             'format': '%(name)s - %(levelname)s - %(message)s',
         },
     },
+    'transport': {
+        # 'browser' sends everything through the browser pages. 'http'
+        # (requires aiohttp) sends requests and streams directly with the
+        # browser's cookies, falling back to the browser on a challenge.
+        'type': 'browser',
+        'pool_size': 10,
+        'challenge_cooldown': 300,
+    },
+    'session': {
+        'persist': True,
+        'filename': 'session.json',
+        # Refresh the session this many seconds before it expires.
+        'refresh_margin': 60 * 10,
+    },
+    'cache': {
+        'enabled': True,
+        'filename': 'response_cache.sqlite',
+        'ttl': 60 * 60 * 24 * 7,
+        'max_entries': 1000,
+    },
+    'conversation_cache': {
+        # Client-side cache of conversation history pages and conversations,
+        # see ConversationCache.
+        'enabled': True,
+        'history_ttl': 60,
+        'max_conversations': 64,
+    },
+    'retry': {
+        'attempts': 3,
+        # Backoff before retry n is base_delay * 2 ** (n - 1) seconds, capped
+        # at max_delay, and with jitter a random delay up to that.
+        'base_delay': 1,
+        'max_delay': 30,
+        'jitter': True,
+        # Each request adds ratio retry tokens, up to max_tokens, and each
+        # retry spends one.
+        'budget': {
+            'ratio': 0.2,
+            'max_tokens': 10,
+        },
+    },
+    'admission': {
+        # Upstream rate limit: requests per second on average, and the
+        # largest burst let through at once. 0 disables rate limiting.
+        'rate': 0.5,
+        'burst': 5,
+        'queue_size': 128,
+        # Queued requests a single client may have, 0 for no limit.
+        'max_per_client': 8,
+        # Share of the queue per client, relative to 1, e.g. {'Notch': 2}.
+        'weights': {},
+    },
+    'proxy': {
+        'host': '127.0.0.1',
+        'port': 23484,
+        'max_connections': 64,
+        # Seconds a request may take, queueing included, unless the client
+        # sends its own timeout.
+        'request_timeout': 300,
+        # Prometheus metrics listener, served at /metrics.
+        'metrics': {
+            'enabled': True,
+            'host': '127.0.0.1',
+            'port': 23485,
+        },
+        # Server-side prompt templates. The preamble is sent once to prime a
+        # conversation; each request then branches from it with only the
+        # rendered prompt.
+        'templates': {
+            'minecraft': {
+                'preamble': "You are an expert in writing minecraft commands. The user gives you a prompt and you turn it into minecraft commands for minecraft the game. Don't give any details or explanation about the code you've written, only give the commands. Format it in a numbered list. These commands will be chained into commands blocks and be executed every tick. ",
+                'prompt': "Prompt: {prompt}. Commands:",
+            },
+        },
+    },
     'debug': {
         'log': {
             'enabled': False,
@@ -38,6 +131,13 @@ DEFAULT_CONFIG = {
             'level': 'debug',
             'format': '%(name)s - %(asctime)s - %(levelname)s - %(message)s',
         },
+        # Chrome trace-event spans of sampled requests, written to the data
+        # dir. Open the file in chrome://tracing or ui.perfetto.dev.
+        'trace': {
+            'enabled': False,
+            'sample_rate': 1.0,
+            'filename': 'trace-{pid}.json',
+        },
     },
 }
 
@@ -0,0 +1,85 @@
+class ConversationTree:
+    """
+    Index over the message mapping of a fetched conversation.
+
+    The backend returns a conversation as a mapping of node ID to node, each
+    node naming its parent. The tree indexes the children of every node once,
+    so following the conversation no longer rescans the whole mapping for
+    each message, and resolves the active branch from current_node instead
+    of following whichever child happens to come first.
+    """
+
+    def __init__(self, conversation_data):
+        self.conversation_id = conversation_data.get('id')
+        self.title = conversation_data.get('title')
+        self.nodes = conversation_data['mapping']
+        self.children = {node_id: [] for node_id in self.nodes}
+        self.roots = []
+        for node_id, node in self.nodes.items():
+            parent_id = node.get('parent')
+            if parent_id in self.children:
+                self.children[parent_id].append(node_id)
+            else:
+                self.roots.append(node_id)
+        current_node = conversation_data.get('current_node')
+        self.current_node = current_node if current_node in self.nodes else self._latest_leaf()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def _latest_leaf(self):
+        # Without a usable current_node, follow the most recent branch.
+        if not self.roots:
+            return None
+        node_id = self.roots[0]
+        while self.children[node_id]:
+            node_id = self.children[node_id][-1]
+        return node_id
+
+    @staticmethod
+    def _visible(message):
+        return message is not None and 'author' in message and message['author']['role'] != 'system'
+
+    def path(self, node_id=None):
+        """
+        Node IDs from the root down to node_id, defaulting to current_node.
+        """
+        node_id = node_id or self.current_node
+        path = []
+        while node_id in self.nodes:
+            path.append(node_id)
+            node_id = self.nodes[node_id].get('parent')
+        path.reverse()
+        return path
+
+    def messages(self, node_id=None):
+        """
+        The user and assistant messages on the path to node_id, defaulting
+        to the active branch.
+        """
+        messages = (self.nodes[path_id]['message'] for path_id in self.path(node_id))
+        return [message for message in messages if self._visible(message)]
+
+    def siblings(self, node_id):
+        """
+        Node IDs of the alternative branches at node_id, including itself,
+        e.g. the regenerated versions of a response.
+        """
+        parent_id = self.nodes[node_id].get('parent')
+        if parent_id in self.children:
+            return list(self.children[parent_id])
+        return list(self.roots)
+
+    def last_message(self, node_id=None):
+        """
+        The last user or assistant message on the path to node_id,
+        defaulting to the active branch, or None.
+        """
+        for path_id in reversed(self.path(node_id)):
+            message = self.nodes[path_id]['message']
+            if self._visible(message):
+                return message
+        return None
@@ -0,0 +1,89 @@
+class ChatGPTError(Exception):
+    """
+    Base class of the errors raised by AsyncChatGPT.
+
+    retryable tells whether sending the same request again may succeed,
+    retry_after is the delay in seconds requested by upstream, if any, and
+    http_status is the status the HTTP APIs answer with.
+    """
+
+    retryable = False
+    http_status = 502
+
+    def __init__(self, message, retryable=None, retry_after=None):
+        super().__init__(message)
+        if retryable is not None:
+            self.retryable = retryable
+        self.retry_after = retry_after
+
+class SessionUnusableError(ChatGPTError):
+    """
+    There is no usable session, either because the user is not logged in
+    or because upstream rejected the access token. A rejected token is
+    retryable, the session has been invalidated and is fetched again.
+    """
+
+    http_status = 503
+
+class UpstreamError(ChatGPTError):
+    """
+    Upstream answered with an error status, or could not be reached at all
+    (status is None). Rate limits and server errors are retryable.
+    """
+
+    def __init__(self, status, message, retry_after=None):
+        retryable = status is None or status == 429 or status >= 500
+        super().__init__(message, retryable, retry_after)
+        self.status = status
+        self.http_status = 429 if status == 429 else 502
+
+    @property
+    def rate_limited(self):
+        return self.status == 429
+
+class StreamTimeoutError(ChatGPTError):
+    """
+    No stream event was received within the timeout.
+    """
+
+    retryable = True
+    http_status = 504
+
+class ResponseDecodeError(ChatGPTError):
+    """
+    The response could not be decoded, or did not contain a message.
+    """
+
+    retryable = True
+
+class OverloadedError(ChatGPTError):
+    """
+    The request was not admitted because the queue, or the client's share
+    of it, is full. retry_after estimates when there will be room.
+    """
+
+    retryable = True
+    http_status = 429
+
+class DeadlineExceededError(ChatGPTError):
+    """
+    The request was not answered before its deadline, it is dropped from
+    the queue or its generation is interrupted.
+    """
+
+    http_status = 504
+
+class GenerationInterruptedError(ChatGPTError):
+    """
+    The generation was stopped on request (SIGUSR1) before it finished,
+    the partial response is not an answer.
+    """
+
+class ChallengeError(ChatGPTError):
+    """
+    Upstream answered a direct HTTP request with a browser challenge, the
+    request has to go through the browser instead.
+    """
+
+    retryable = True
+    http_status = 503
@@ -0,0 +1,343 @@
+import argparse
+import datetime
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FAKE_ACCESS_TOKEN = "fake-access-token"
+
+CHAT_PAGE = b"""<!DOCTYPE html>
+<html><head><title>Fake ChatGPT</title></head>
+<body><p>Local stand-in for chat.openai.com.</p></body></html>
+"""
+
+FILLER = (
+    "/fill ~-5 ~-1 ~-5 ~5 ~-1 ~5 minecraft:stone /setblock ~ ~ ~ minecraft:command_block "
+    "/summon minecraft:pig ~ ~1 ~ /give @p minecraft:diamond 1 /time set day"
+).split()
+
+def _timestamp():
+    return time.time()
+
+def _isoformat(timestamp):
+    # History items carry ISO times without a zone, conversation bodies
+    # carry epoch seconds, as the real backend does.
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+class FakeChatGPT:
+    """
+    In-memory conversations, shaped like the backend-api responses.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conversations = {}
+
+    def _new_conversation(self):
+        now = _timestamp()
+        root_id = str(uuid.uuid4())
+        conversation = {
+            "id": str(uuid.uuid4()),
+            "title": "New chat",
+            "create_time": now,
+            "update_time": now,
+            "mapping": {root_id: {"id": root_id, "message": None, "parent": None, "children": []}},
+            "current_node": root_id,
+            "moderation_results": [],
+            "is_visible": True,
+        }
+        self.conversations[conversation["id"]] = conversation
+        return conversation
+
+    def _add_node(self, conversation, node_id, parent_id, role, text):
+        mapping = conversation["mapping"]
+        if parent_id not in mapping:
+            parent_id = next(node["id"] for node in mapping.values() if node["parent"] is None)
+        mapping[node_id] = {
+            "id": node_id,
+            "message": {
+                "id": node_id,
+                "author": {"role": role},
+                "create_time": _timestamp(),
+                "content": {"content_type": "text", "parts": [text]},
+            },
+            "parent": parent_id,
+            "children": [],
+        }
+        mapping[parent_id]["children"].append(node_id)
+        conversation["current_node"] = node_id
+        conversation["update_time"] = _timestamp()
+        return mapping[node_id]
+
+    def start_reply(self, request):
+        """
+        Record the user message of a conversation request and return the
+        conversation ID and the ID of the assistant message to stream.
+        """
+        message = request["messages"][0]
+        with self.lock:
+            conversation = self.conversations.get(request.get("conversation_id")) or self._new_conversation()
+            self._add_node(conversation, message["id"], request.get("parent_message_id"), "user", message["content"]["parts"][0])
+            reply = self._add_node(conversation, str(uuid.uuid4()), message["id"], "assistant", "")
+        return conversation["id"], reply["id"]
+
+    def update_reply(self, conversation_id, message_id, text):
+        with self.lock:
+            conversation = self.conversations[conversation_id]
+            conversation["mapping"][message_id]["message"]["content"]["parts"] = [text]
+            conversation["update_time"] = _timestamp()
+
+    def history(self, offset, limit):
+        with self.lock:
+            items = sorted(
+                (c for c in self.conversations.values() if c["is_visible"]),
+                key=lambda c: c["update_time"],
+                reverse=True,
+            )
+            page = [
+                {
+                    "id": c["id"],
+                    "title": c["title"],
+                    "create_time": _isoformat(c["create_time"]),
+                    "update_time": _isoformat(c["update_time"]),
+                }
+                for c in items[offset:offset + limit]
+            ]
+        return {"items": page, "total": len(items), "limit": limit, "offset": offset}
+
+    def get(self, conversation_id):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None or not conversation["is_visible"]:
+                return None
+            return json.loads(json.dumps(conversation))
+
+    def update(self, conversation_id, data):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                return False
+            if "title" in data:
+                conversation["title"] = data["title"]
+            if "is_visible" in data:
+                conversation["is_visible"] = bool(data["is_visible"])
+            conversation["update_time"] = _timestamp()
+            return True
+
+    def generate_title(self, conversation_id):
+        with self.lock:
+            conversation = self.conversations.get(conversation_id)
+            if conversation is None:
+                return None
+            first = next(
+                (node["message"] for node in conversation["mapping"].values()
+                 if node["message"] and node["message"]["author"]["role"] == "user"),
+                None,
+            )
+            words = first["content"]["parts"][0].split()[:5] if first else []
+            conversation["title"] = " ".join(words) or "New chat"
+            conversation["update_time"] = _timestamp()
+            return conversation["title"]
+
+class FakeChatGPTServer(ThreadingHTTPServer):
+    """
+    Local stand-in for chat.openai.com, for testing and benchmarking the
+    wrapper offline: point chat.base_url at it and the real Playwright code
+    path runs against it.
+
+    Serves /api/auth/session, the backend-api/conversation event stream,
+    the conversations history, single conversations, gen_title and PATCH.
+    Replies stream tokens words at token_rate words per second after
+    latency seconds, and fail with a 500 at error_rate or a 429 with
+    Retry-After at rate_limit_rate.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=8089, token_rate=20.0, tokens=40, latency=0.5,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after=5):
+        super().__init__((host, port), FakeChatGPTHandler)
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.chatgpt = FakeChatGPT()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """
+        Serve from a background thread, e.g. within a benchmark.
+        """
+        thread = threading.Thread(target=self.serve_forever, name="FakeChatGPTServer", daemon=True)
+        thread.start()
+        return thread
+
+class FakeChatGPTHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data, headers={}):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return {}
+
+    def _authorized(self):
+        if self.headers.get("Authorization") == f"Bearer {FAKE_ACCESS_TOKEN}":
+            return True
+        self._send_json(401, {"detail": "Unauthorized"})
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if url.path == "/api/auth/session":
+            expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+            self._send_json(200, {
+                "user": {"id": "user-fake", "name": "Fake User", "email": "fake@example.com"},
+                "expires": expires.isoformat().replace("+00:00", "Z"),
+                "accessToken": FAKE_ACCESS_TOKEN,
+            })
+        elif url.path == "/backend-api/conversations":
+            if not self._authorized():
+                return
+            query = parse_qs(url.query)
+            offset = int(query.get("offset", ["0"])[0])
+            limit = int(query.get("limit", ["20"])[0])
+            self._send_json(200, self.server.chatgpt.history(offset, limit))
+        elif parts[:2] == ["backend-api", "conversation"] and len(parts) == 3:
+            if not self._authorized():
+                return
+            conversation = self.server.chatgpt.get(parts[2])
+            if conversation is None:
+                self._send_json(404, {"detail": "Conversation not found"})
+            else:
+                self._send_json(200, conversation)
+        elif parts[0] in ("api", "backend-api"):
+            self._send_json(404, {"detail": "Not found"})
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(CHAT_PAGE)))
+            self.end_headers()
+            self.wfile.write(CHAT_PAGE)
+
+    def do_PATCH(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts[:2] != ["backend-api", "conversation"] or len(parts) != 3:
+            self._send_json(404, {"detail": "Not found"})
+            return
+        if not self._authorized():
+            return
+        if self.server.chatgpt.update(parts[2], self._read_json()):
+            self._send_json(200, {"success": True})
+        else:
+            self._send_json(404, {"detail": "Conversation not found"})
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts[:3] == ["backend-api", "conversation", "gen_title"] and len(parts) == 4:
+            if not self._authorized():
+                return
+            self._read_json()
+            title = self.server.chatgpt.generate_title(parts[3])
+            if title is None:
+                self._send_json(404, {"detail": "Conversation not found"})
+            else:
+                self._send_json(200, {"title": title})
+        elif parts == ["backend-api", "conversation"]:
+            if not self._authorized():
+                return
+            self._conversation(self._read_json())
+        else:
+            self._send_json(404, {"detail": "Not found"})
+
+    def _conversation(self, request):
+        server = self.server
+        if random.random() < server.rate_limit_rate:
+            self._send_json(429, {"detail": "Too many requests in 1 hour. Try again later."},
+                            {"Retry-After": str(server.retry_after)})
+            return
+        if random.random() < server.error_rate:
+            self._send_json(500, {"detail": "Something went wrong"})
+            return
+        try:
+            prompt = request["messages"][0]["content"]["parts"][0]
+        except (KeyError, IndexError, TypeError):
+            self._send_json(400, {"detail": "Malformed request"})
+            return
+        conversation_id, message_id = server.chatgpt.start_reply(request)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+
+        time.sleep(server.latency)
+        words = f"Fake response to: {prompt}".split()
+        words += [FILLER[i % len(FILLER)] for i in range(max(0, server.tokens - len(words)))]
+        text = ""
+        try:
+            for index, word in enumerate(words):
+                text = f"{text} {word}" if text else word
+                server.chatgpt.update_reply(conversation_id, message_id, text)
+                event = {
+                    "message": {
+                        "id": message_id,
+                        "author": {"role": "assistant"},
+                        "content": {"content_type": "text", "parts": [text]},
+                        "end_turn": index == len(words) - 1 or None,
+                    },
+                    "conversation_id": conversation_id,
+                    "error": None,
+                }
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+                if server.token_rate:
+                    time.sleep(1 / server.token_rate)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The stream was aborted by the client.
+            pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for chat.openai.com")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--token-rate", type=float, default=20.0, help="words streamed per second, 0 for no delay")
+    parser.add_argument("--tokens", type=int, default=40, help="words per response")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the first word")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests failing with 429")
+    parser.add_argument("--retry-after", type=int, default=5, help="Retry-After of 429 responses")
+    args = parser.parse_args()
+    server = FakeChatGPTServer(
+        args.host, args.port, args.token_rate, args.tokens, args.latency,
+        args.error_rate, args.rate_limit_rate, args.retry_after,
+    )
+    print(f"Fake ChatGPT listening on {server.base_url}, set chat.base_url to use it")
+    server.serve_forever()
@@ -1,163 +1,154 @@
 import argparse
 
-from flask import Flask, jsonify, request
-
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+
+from chatgpt_wrapper.api_handlers import (
+    SSE_HEADERS,
+    ApiHandlers,
+    bypass_cache_from_request,
+    client_from_request,
+    error_response,
+    parse_batch_items,
+    session_id_from_request,
+    timeout_from_request,
+)
 from chatgpt_wrapper.chatgpt import ChatGPT
 from chatgpt_wrapper.config import Config
+import chatgpt_wrapper.metrics as metrics
+from chatgpt_wrapper.tracing import get_tracer
 
 
 def create_application(name, config=None, timeout=60, proxy=None):
+    """
+    WSGI application serving the API of api_handlers.ApiHandlers, where
+    each route is documented. Handlers run on the event loop of ChatGPT.
+    """
     config = config or Config()
     app = Flask(name)
     chatgpt = ChatGPT(config, timeout, proxy)
-
-    def _error_handler(message):
-        return jsonify({"success": False, "error": str(message)}), 500
+    handlers = ApiHandlers(config, config.get('browser.pages'))
+    tracer = get_tracer(config)
+
+    @app.before_request
+    def start_trace():
+        g.trace = tracer.request(f"api {request.method} {request.path}", session_id=session_id_from_request(request))
+        g.trace.__enter__()
+
+    @app.teardown_request
+    def finish_trace(_error):
+        trace = g.pop("trace", None)
+        if trace is not None:
+            trace.__exit__(None, None, None)
+
+    def _respond(result):
+        body, status, headers = result
+        if isinstance(body, (dict, list)):
+            body = jsonify(body)
+        return body, status, headers
+
+    def _run(handler, *args):
+        return _respond(chatgpt.async_run(handler(chatgpt.agpt, *args)))
+
+    def _iterate(chunks):
+        # Step the handler's generator on the loop for every chunk.
+        try:
+            while True:
+                try:
+                    yield chatgpt.async_run(chunks.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            chatgpt.async_run(chunks.aclose())
+
+    def _conversation():
+        return chatgpt.get_session(session_id_from_request(request))
 
     @app.route("/conversations", methods=["POST"])
     def ask():
         """
-        Ask a question.
+        Ask a question, see ApiHandlers.ask.
+        """
+        prompt = request.get_data().decode("utf-8")
+        return _run(handlers.ask, _conversation(), client_from_request(request), prompt, bypass_cache_from_request(request), timeout_from_request(request))
 
-        Path:
-            POST /conversations
+    @app.route("/conversations/stream", methods=["POST"])
+    def ask_stream():
+        """
+        Ask a question, streaming the response, see ApiHandlers.ask_stream.
+        """
+        prompt = request.get_data().decode("utf-8")
+        chunks = handlers.ask_stream(chatgpt.agpt, _conversation(), client_from_request(request), prompt, timeout_from_request(request))
+        return Response(stream_with_context(_iterate(chunks)), mimetype="text/event-stream", headers=SSE_HEADERS)
 
-        Request Body:
-            STRING:
-                Some text.
+    @app.route("/conversations/batch", methods=["POST"])
+    def ask_batch():
+        """
+        Ask several questions at once, see ApiHandlers.ask_batch.
+        """
+        items = parse_batch_items(request.get_json())
+        if items is None:
+            return _respond(error_response("Request body must contain a list of prompts"))
+        lines = handlers.ask_batch(chatgpt.agpt, _conversation(), client_from_request(request), items)
+        return Response(stream_with_context(_iterate(lines)), mimetype="application/x-ndjson")
+
+    @app.route("/cache", methods=["GET"])
+    def get_cache_stats():
+        """
+        Retrieve response cache statistics, see ApiHandlers.cache_stats.
+        """
+        return _respond(handlers.cache_stats())
 
-        Returns:
-            STRING:
-                Some response.
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
         """
-        prompt = request.get_data().decode("utf-8")
-        result = chatgpt.ask(prompt)
-        return result
+        Retrieve metrics in the Prometheus text format.
+
+        Path:
+            GET /metrics
+        """
+        return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
 
     @app.route("/conversations/new", methods=["POST"])
     def new_conversation():
         """
-        Start a new conversation.
-
-        Path:
-            POST /conversations/new
+        Start a new conversation, see ApiHandlers.new_conversation.
+        """
+        return _respond(handlers.new_conversation(chatgpt.agpt, session_id_from_request(request)))
 
-        Returns:
-            JSON:
-                {
-                    "success": true,
-                }
+    @app.route("/conversations/<string:conversation_id>", methods=["GET"])
+    def get_conversation(conversation_id):
+        """
+        Retrieve the messages of a conversation, see ApiHandlers.get_conversation.
+        """
+        return _run(handlers.get_conversation, conversation_id, request.args.get("message_id"))
 
-            JSON:
-                {
-                    "success": false,
-                    "error": "Failed to start new conversation"
-                }
+    @app.route("/conversations/<string:conversation_id>/switch", methods=["POST"])
+    def switch_conversation(conversation_id):
         """
-        chatgpt.new_conversation()
-        return jsonify({"success": True, "parent_message_id": chatgpt.parent_message_id})
+        Continue an existing conversation, see ApiHandlers.switch_conversation.
+        """
+        return _run(handlers.switch_conversation, conversation_id, session_id_from_request(request), request.args.get("message_id"))
 
     @app.route("/conversations/<string:conversation_id>", methods=["DELETE"])
     def delete_conversation(conversation_id):
         """
-        Delete a conversation.
-
-        Path:
-            DELETE /conversations/:conversation_id
-
-        Parameters:
-            conversation_id (str): The ID of the conversation to delete.
-
-        Returns:
-            JSON:
-                {
-                    "success": true,
-                }
-
-            JSON:
-                {
-                    "success": false,
-                    "error": "Failed to delete conversation"
-                }
+        Delete a conversation, see ApiHandlers.delete_conversation.
         """
-        result = chatgpt.delete_conversation(conversation_id)
-        if result:
-            return jsonify(result)
-        else:
-            return _error_handler("Failed to delete conversation")
+        return _run(handlers.delete_conversation, conversation_id)
 
     @app.route("/conversations/<string:conversation_id>/set-title", methods=["PATCH"])
     def set_title(conversation_id):
         """
-        Set the title of a conversation.
-
-        Path:
-            PATCH /conversations/:conversation_id/set-title
-
-        Parameters:
-            conversation_id (str): The ID of the conversation to set the title for.
-
-        Request Body:
-            JSON:
-                {
-                    "title": "New Title"
-                }
-
-        Returns:
-            JSON:
-                {
-                    "success": true,
-                }
-
-            JSON:
-                {
-                    "success": false,
-                    "error": "Failed to set title"
-                }
-        """
-        json = request.get_json()
-        title = json["title"]
-        result = chatgpt.set_title(title, conversation_id=conversation_id)
-        if result:
-            return jsonify(result)
-        else:
-            return _error_handler("Failed to set title")
+        Set the title of a conversation, see ApiHandlers.set_title.
+        """
+        return _run(handlers.set_title, conversation_id, request.get_json(silent=True))
 
     @app.route("/history", methods=["GET"])
     def get_history():
         """
-        Retrieve conversation history.
-
-        Path:
-            GET /history
-
-        Query Parameters:
-            limit (int, optional): The maximum number of conversations to return (default is 20).
-            offset (int, optional): The number of conversations to skip before starting to return results (default is 0).
-
-        Returns:
-            JSON:
-                {
-                    ":conversation_id": {
-                        "id": "abc123",
-                        "title": "Conversation Title",
-                        ...
-                    },
-                    ...
-                }
-
-            JSON:
-                {
-                    "error": "Failed to get history"
-                }
-        """
-        limit = request.args.get("limit", 20)
-        offset = request.args.get("offset", 0)
-        result = chatgpt.get_history(limit=limit, offset=offset)
-        if result:
-            return jsonify(result)
-        else:
-            return _error_handler("Failed to get history")
+        Retrieve conversation history, see ApiHandlers.get_history.
+        """
+        return _run(handlers.get_history, request.args.get("limit", 20), request.args.get("offset", 0))
 
     return app
 
@@ -0,0 +1,166 @@
+import argparse
+
+from quart import Quart, Response, g, jsonify, request
+
+from chatgpt_wrapper.api_handlers import (
+    SSE_HEADERS,
+    ApiHandlers,
+    bypass_cache_from_request,
+    client_from_request,
+    error_response,
+    parse_batch_items,
+    session_id_from_request,
+    timeout_from_request,
+)
+from chatgpt_wrapper.chatgpt import AsyncChatGPT
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.tracing import get_tracer
+import chatgpt_wrapper.metrics as metrics
+
+
+def create_application(name, config=None, timeout=60, proxy=None):
+    """
+    ASGI counterpart of gpt_api.create_application.
+
+    Serves the same routes, but awaits AsyncChatGPT directly on the server's
+    event loop, so many requests can be in flight at once without
+    re-entering the loop for every operation.
+    """
+    config = config or Config()
+    app = Quart(name)
+    handlers = ApiHandlers(config, config.get('browser.pages'))
+    tracer = get_tracer(config)
+    backend = {}
+
+    @app.before_serving
+    async def startup():
+        backend["chatgpt"] = await AsyncChatGPT(config).create(timeout, proxy)
+
+    @app.after_serving
+    async def shutdown():
+        await backend["chatgpt"].cleanup()
+        handlers.close()
+        tracer.close()
+
+    @app.before_request
+    async def start_trace():
+        g.trace = tracer.request(f"api {request.method} {request.path}", session_id=session_id_from_request(request))
+        g.trace.__enter__()
+
+    @app.teardown_request
+    async def finish_trace(_error):
+        trace = g.pop("trace", None)
+        if trace is not None:
+            trace.__exit__(None, None, None)
+
+    def _chatgpt():
+        return backend["chatgpt"]
+
+    def _conversation():
+        return _chatgpt().get_session(session_id_from_request(request))
+
+    def _respond(result):
+        body, status, headers = result
+        if isinstance(body, (dict, list)):
+            body = jsonify(body)
+        return body, status, headers
+
+    async def _run(handler, *args):
+        return _respond(await handler(_chatgpt(), *args))
+
+    @app.route("/conversations", methods=["POST"])
+    async def ask():
+        """
+        Ask a question, see ApiHandlers.ask.
+        """
+        prompt = (await request.get_data()).decode("utf-8")
+        return await _run(handlers.ask, _conversation(), client_from_request(request), prompt, bypass_cache_from_request(request), timeout_from_request(request))
+
+    @app.route("/conversations/stream", methods=["POST"])
+    async def ask_stream():
+        """
+        Ask a question, streaming the response, see ApiHandlers.ask_stream.
+        """
+        prompt = (await request.get_data()).decode("utf-8")
+        chunks = handlers.ask_stream(_chatgpt(), _conversation(), client_from_request(request), prompt, timeout_from_request(request))
+        return Response(chunks, mimetype="text/event-stream", headers=SSE_HEADERS)
+
+    @app.route("/conversations/batch", methods=["POST"])
+    async def ask_batch():
+        """
+        Ask several questions at once, see ApiHandlers.ask_batch.
+        """
+        items = parse_batch_items(await request.get_json())
+        if items is None:
+            return _respond(error_response("Request body must contain a list of prompts"))
+        lines = handlers.ask_batch(_chatgpt(), _conversation(), client_from_request(request), items)
+        return Response(lines, mimetype="application/x-ndjson")
+
+    @app.route("/cache", methods=["GET"])
+    async def get_cache_stats():
+        """
+        Retrieve response cache statistics, see ApiHandlers.cache_stats.
+        """
+        return _respond(handlers.cache_stats())
+
+    @app.route("/metrics", methods=["GET"])
+    async def get_metrics():
+        """
+        Retrieve metrics in the Prometheus text format.
+
+        Path:
+            GET /metrics
+        """
+        return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+    @app.route("/conversations/new", methods=["POST"])
+    async def new_conversation():
+        """
+        Start a new conversation, see ApiHandlers.new_conversation.
+        """
+        return _respond(handlers.new_conversation(_chatgpt(), session_id_from_request(request)))
+
+    @app.route("/conversations/<string:conversation_id>", methods=["GET"])
+    async def get_conversation(conversation_id):
+        """
+        Retrieve the messages of a conversation, see ApiHandlers.get_conversation.
+        """
+        return await _run(handlers.get_conversation, conversation_id, request.args.get("message_id"))
+
+    @app.route("/conversations/<string:conversation_id>/switch", methods=["POST"])
+    async def switch_conversation(conversation_id):
+        """
+        Continue an existing conversation, see ApiHandlers.switch_conversation.
+        """
+        return await _run(handlers.switch_conversation, conversation_id, session_id_from_request(request), request.args.get("message_id"))
+
+    @app.route("/conversations/<string:conversation_id>", methods=["DELETE"])
+    async def delete_conversation(conversation_id):
+        """
+        Delete a conversation, see ApiHandlers.delete_conversation.
+        """
+        return await _run(handlers.delete_conversation, conversation_id)
+
+    @app.route("/conversations/<string:conversation_id>/set-title", methods=["PATCH"])
+    async def set_title(conversation_id):
+        """
+        Set the title of a conversation, see ApiHandlers.set_title.
+        """
+        return await _run(handlers.set_title, conversation_id, await request.get_json(silent=True))
+
+    @app.route("/history", methods=["GET"])
+    async def get_history():
+        """
+        Retrieve conversation history, see ApiHandlers.get_history.
+        """
+        return await _run(handlers.get_history, request.args.get("limit", 20), request.args.get("offset", 0))
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    app = create_application("chatgpt")
+    app.run(host="0.0.0.0", port=args.port)
@@ -18,6 +18,7 @@ from rich.console import Console
 from rich.markdown import Markdown
 
 from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.errors import ChatGPTError, GenerationInterruptedError
 from chatgpt_wrapper.logger import Logger
 import chatgpt_wrapper.constants as constants
 
@@ -200,9 +201,9 @@ class GPTShell():
     async def cleanup(self):
         pass
 
-    async def _fetch_history(self, limit=constants.DEFAULT_HISTORY_LIMIT, offset=0):
+    async def _fetch_history(self, limit=constants.DEFAULT_HISTORY_LIMIT, offset=0, refresh=False):
         self._print_markdown("* Fetching conversation history...")
-        history = await self.backend.get_history(limit=limit, offset=offset)
+        history = await self.backend.get_history(limit=limit, offset=offset, refresh=refresh)
         return history
 
     async def _set_title(self, title, conversation_id=None):
@@ -324,7 +325,9 @@ class GPTShell():
                     except ValueError:
                         self._print_markdown("* Invalid offset, must be an integer")
                         return
-        history = await self._fetch_history(limit=limit, offset=offset)
+        # Listing the history always refreshes it, the other commands resolve
+        # history numbers against what was last listed.
+        history = await self._fetch_history(limit=limit, offset=offset, refresh=True)
         if history:
             history_list = [h for h in history.values()]
             self._print_markdown("## Recent history:\n\n%s" % "\n".join(["1. %s: %s (%s)" % (datetime.datetime.strptime(h['create_time'], "%Y-%m-%dT%H:%M:%S.%f").strftime("%Y-%m-%d %H:%M"), h['title'], h['id']) for h in history_list]))
@@ -454,9 +457,9 @@ class GPTShell():
             if not self.backend.conversation_id:
                 self._print_markdown("* Current conversation is empty, you must send information first")
                 return
-        conversation_data = await self.backend.get_conversation(conversation_id)
-        if conversation_data:
-            messages = self.backend.conversation_data_to_messages(conversation_data)
+        tree = await self.backend.get_conversation_tree(conversation_id)
+        if tree:
+            messages = tree.messages()
             if title:
                 self._print_markdown(f"### {title}")
             self._print_markdown(self._conversation_from_messages(messages))
@@ -504,12 +507,9 @@ class GPTShell():
         if conversation_id and conversation_id == self.backend.conversation_id:
             self._print_markdown("* You are already in chat: %s" % title)
             return
-        conversation_data = await self.backend.get_conversation(conversation_id)
-        if conversation_data:
-            messages = self.backend.conversation_data_to_messages(conversation_data)
-            message = messages.pop()
-            self.backend.conversation_id = conversation_id
-            self.backend.parent_message_id = message['id']
+        tree = await self.backend.get_conversation_tree(conversation_id)
+        if tree:
+            self.backend.switch_conversation(tree)
             self._update_message_map()
             self._write_log_context()
             if title:
@@ -532,21 +532,30 @@ class GPTShell():
         if not line:
             return
 
-        if self.stream:
-            response = ""
-            first = True
-            async for chunk in self.backend.ask_stream(line):
-                if first:
-                    print("")
-                    first = False
-                print(chunk, end="")
-                sys.stdout.flush()
-                response += chunk
-            print("\n")
-        else:
-            response = await self.backend.ask(line)
+        try:
+            if self.stream:
+                response = ""
+                first = True
+                async for chunk in self.backend.ask_stream(line):
+                    if first:
+                        print("")
+                        first = False
+                    print(chunk, end="")
+                    sys.stdout.flush()
+                    response += chunk
+                print("\n")
+            else:
+                response = await self.backend.ask(line)
+                print("")
+                self._print_markdown(response)
+        except GenerationInterruptedError:
+            print("\nGeneration stopped\n")
+            self._update_message_map()
+            return
+        except ChatGPTError as e:
             print("")
-            self._print_markdown(response)
+            self._print_markdown(f"* {e}")
+            return
 
         self._write_log(line, response)
         self._update_message_map()
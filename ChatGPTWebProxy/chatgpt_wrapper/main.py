@@ -3,6 +3,7 @@ import sys
 import asyncio
 
 from chatgpt_wrapper.browser_shell import BrowserShell
+from chatgpt_wrapper.browser_server import serve
 from chatgpt_wrapper.version import __version__
 from chatgpt_wrapper.config import Config
 
@@ -23,7 +24,7 @@ async def async_main():
     parser.add_argument(
         "params",
         nargs="*",
-        help="Use 'install' for install mode, or provide a prompt for ChatGPT.",
+        help="Use 'install' for install mode, 'browser-server' to run a long-lived browser ('browser-server install' to log in to it), or provide a prompt for ChatGPT.",
     )
     parser.add_argument(
         "-c",
@@ -100,6 +101,19 @@ async def async_main():
         )
         config.set('browser.debug', True)
 
+    if len(args.params) > 0 and args.params[0] == "browser-server":
+        if args.params[1:] == ["install"]:
+            print(
+                "Install mode: Log in to ChatGPT in the browser that pops up, and click\n"
+                "through all the dialogs, etc. Once that is achieved, stop the server and\n"
+                "start it again without the 'install' parameter.\n"
+            )
+            config.set('browser.debug', True)
+        elif args.params[1:]:
+            parser.error("'browser-server' only accepts 'install'")
+        await serve(config)
+        return
+
     config.set('chat.streaming', args.stream)
     if args.log is not None:
         config.set('chat.log.enabled', True)
@@ -0,0 +1,182 @@
+import asyncio
+import bisect
+import math
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Set it, or give it a function that is
+    called whenever the metrics are collected.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        self.functions[self._key(labels)] = function
+
+    def _samples(self):
+        for key, function in self.functions.items():
+            self.values[key] = function()
+        return super()._samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        if key not in self.values:
+            self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0, "count": 0}
+        data = self.values[key]
+        data["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        data["sum"] += value
+        data["count"] += 1
+
+    def _samples(self):
+        for key, data in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, data["counts"]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(data['sum'])}"
+            yield f"{self.name}_count{labels} {data['count']}"
+
+class Registry:
+    """
+    Collects metrics and renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+QUEUE_DEPTH = REGISTRY.gauge(
+    "minegpt_queue_depth", "Requests waiting to be admitted.", ["queue"])
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "minegpt_queue_wait_seconds", "Time requests spent queued before starting.", ["queue"])
+PAGE_WAIT_SECONDS = REGISTRY.histogram(
+    "minegpt_page_wait_seconds", "Time spent waiting for a free browser page.")
+FIRST_CHUNK_SECONDS = REGISTRY.histogram(
+    "minegpt_first_chunk_seconds", "Time from sending a prompt to its first chunk.")
+GENERATION_SECONDS = REGISTRY.histogram(
+    "minegpt_generation_seconds", "Total time to generate a response.")
+STREAM_EVENTS = REGISTRY.histogram(
+    "minegpt_stream_events", "Stream events processed per generation.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+SESSION_REFRESHES = REGISTRY.counter(
+    "minegpt_session_refreshes_total", "Session fetches, by method.", ["method"])
+RETRIES = REGISTRY.counter(
+    "minegpt_retries_total", "Retried attempts, by error class.", ["error"])
+FAILURES = REGISTRY.counter(
+    "minegpt_failures_total", "Failed attempts, by error class.", ["error"])
+REJECTIONS = REGISTRY.counter(
+    "minegpt_rejections_total", "Requests rejected by admission control.")
+CACHE_LOOKUPS = REGISTRY.counter(
+    "minegpt_cache_lookups_total", "Response cache lookups, by result.", ["result"])
+BROWSER_RESTARTS = REGISTRY.counter(
+    "minegpt_browser_restarts_total", "Browsers swapped out for a new one.")
+
+async def serve_metrics(host, port, registry=REGISTRY):
+    """
+    Serve GET /metrics over a minimal HTTP listener, for processes without
+    a web framework such as the socket proxy.
+    """
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, content_type, body = "200 OK", CONTENT_TYPE, registry.render().encode()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,97 @@
+import asyncio
+import random
+
+from playwright.async_api import Error as PlaywrightError
+
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.errors import ChatGPTError
+from chatgpt_wrapper.logger import Logger
+import chatgpt_wrapper.metrics as metrics
+
+class RetryBudget:
+    """
+    Limits retries to a fraction of the requests made.
+
+    Every request deposits ratio tokens, up to max_tokens, and every retry
+    spends one. While upstream keeps failing the budget runs dry and
+    requests fail after their first attempt, instead of multiplying the
+    load on a service that is already rate limiting us.
+    """
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+
+    def deposit(self):
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class RetryPolicy:
+    """
+    Retries operations that failed with a retryable error, with capped
+    exponential backoff and full jitter, honouring the delay upstream asks
+    for when it rate limits us.
+
+    ChatGPTError subclasses say whether they are retryable. Playwright
+    errors mean the browser failed and are retried as well, anything else
+    is a bug and raised straight away.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.attempts = max(1, self.config.get('retry.attempts'))
+        self.base_delay = self.config.get('retry.base_delay')
+        self.max_delay = self.config.get('retry.max_delay')
+        self.jitter = self.config.get('retry.jitter')
+        self.budget = RetryBudget(
+            self.config.get('retry.budget.ratio'),
+            self.config.get('retry.budget.max_tokens'),
+        )
+
+    def is_retryable(self, error):
+        if isinstance(error, ChatGPTError):
+            return error.retryable
+        return isinstance(error, PlaywrightError)
+
+    def delay(self, error, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            delay = max(delay, min(self.max_delay, retry_after))
+        return delay
+
+    async def run(self, operation):
+        """
+        Await operation() until it succeeds, the error is not retryable,
+        the attempts are used up or the retry budget is exhausted, in which
+        case the last error is raised.
+
+        Args:
+            operation (callable): Returns a new awaitable for every attempt.
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await operation()
+            except Exception as e:
+                metrics.FAILURES.inc(error=e.__class__.__name__)
+                if attempt >= self.attempts or not self.is_retryable(e):
+                    raise
+                if not self.budget.withdraw():
+                    self.log.warning("Retry budget exhausted, not retrying")
+                    raise
+                metrics.RETRIES.inc(error=e.__class__.__name__)
+                delay = self.delay(e, attempt)
+                self.log.warning(f"Attempt {attempt} failed ({e.__class__.__name__}: {e}), retrying in {delay:.1f} seconds")
+                await asyncio.sleep(delay)
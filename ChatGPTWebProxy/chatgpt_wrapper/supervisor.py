@@ -0,0 +1,99 @@
+import asyncio
+from typing import Optional
+from playwright._impl._api_structures import ProxySettings
+
+from chatgpt_wrapper.chatgpt import AsyncChatGPT
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.logger import Logger
+import chatgpt_wrapper.metrics as metrics
+
+class ChatGPTSupervisor:
+    """
+    Keeps an active AsyncChatGPT plus a warmed standby instance.
+
+    The standby is launched, navigated and has its session refreshed in the
+    background, so replacing a failed or recycled browser is a swap rather
+    than a cold start. A new standby is warmed after every swap.
+    """
+
+    def __init__(self, config=None, timeout=60, proxy: Optional[ProxySettings] = None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.timeout = timeout
+        self.proxy = proxy
+        # Instances attached to a browser server share its pages, a standby
+        # would be the very same browser.
+        self.standby_enabled = self.config.get('browser.standby') and not self.config.get('browser.server.enabled')
+        self.active = None
+        self.standby = None
+        self.swap_lock = asyncio.Lock()
+
+    async def start(self):
+        self.active = await self._launch()
+        self._warm_standby()
+        return self
+
+    async def _launch(self):
+        # Instances overlap during a swap, each runs on its own copy of the
+        # profile.
+        gpt = await AsyncChatGPT(self.config).create(self.timeout, self.proxy, copy_profile=True)
+        await gpt._ensure_session()
+        # Creating an instance installs its signal handler, make sure the
+        # active instance is the one that receives it.
+        if self.active is not None:
+            self.active._setup_signal_handlers()
+        return gpt
+
+    def _warm_standby(self):
+        if self.standby_enabled:
+            self.log.info("Warming standby browser")
+            self.standby = asyncio.create_task(self._launch())
+            self.standby.add_done_callback(self._standby_done)
+
+    def _standby_done(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.log.error(f"Standby browser failed to start: {task.exception()}")
+    async def swap(self, failed=None):
+        """
+        Replace the active instance with the standby, launching one if none
+        is ready. If failed is given and another caller has already swapped
+        it out, nothing is done.
+        """
+        async with self.swap_lock:
+            if failed is not None and failed is not self.active:
+                return self.active
+            old = self.active
+            new = None
+            if self.standby is not None:
+                try:
+                    new = await self.standby
+                except Exception:
+                    self.log.error("Standby browser failed to start")
+                self.standby = None
+            if new is None:
+                new = await self._launch()
+            new.conversation = old.conversation
+            new.sessions = old.sessions
+            self.active = new
+            self.active._setup_signal_handlers()
+            self.log.info("Swapped in standby browser")
+            metrics.BROWSER_RESTARTS.inc()
+            self._warm_standby()
+            asyncio.create_task(self._retire(old))
+            return self.active
+
+    async def _retire(self, gpt):
+        try:
+            await gpt.cleanup()
+        except Exception:
+            self.log.error("Failed to clean up retired browser")
+
+    async def cleanup(self):
+        if self.standby is not None:
+            try:
+                await self._retire(await self.standby)
+            except Exception:
+                self.log.error("Standby browser failed to start")
+            self.standby = None
+        if self.active is not None:
+            await self.active.cleanup()
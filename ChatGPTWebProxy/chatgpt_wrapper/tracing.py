@@ -0,0 +1,113 @@
+import contextvars
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from chatgpt_wrapper.config import Config
+from chatgpt_wrapper.logger import Logger
+
+_current_trace = contextvars.ContextVar("chatgpt_wrapper_trace", default=None)
+
+_tracers = {}
+
+def get_tracer(config=None):
+    """
+    Return the tracer writing to the trace file of the given config, so
+    every component of a process adds its spans to the same file.
+    """
+    tracer = Tracer(config)
+    return _tracers.setdefault(tracer.filepath, tracer)
+
+class Tracer:
+    """
+    Opt-in tracing of requests (debug.trace section of the config).
+
+    A request opens a trace, sampled at debug.trace.sample_rate, and every
+    span opened while handling it - in the same task or in tasks created
+    from it - is recorded as a Chrome trace event tagged with the request
+    ID. Each request gets its own row in the viewer.
+
+    Events are appended to a JSON array in the data dir as they complete.
+    The array is left unterminated, which chrome://tracing and Perfetto
+    accept, so the file can be loaded while the process is still running.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.enabled = self.config.get('debug.trace.enabled')
+        self.sample_rate = self.config.get('debug.trace.sample_rate')
+        self.filepath = os.path.join(
+            self.config.data_dir,
+            self.config.get('debug.trace.filename').format(pid=os.getpid()),
+        )
+        self.pid = os.getpid()
+        self.file = None
+        self.lock = threading.Lock()
+        self.rows = itertools.count(1)
+
+    def _write(self, event):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.filepath, "w")
+                self.file.write("[\n")
+                self.log.info(f"Writing trace events to {self.filepath}")
+            self.file.write(json.dumps(event) + ",\n")
+            self.file.flush()
+
+    @contextmanager
+    def request(self, name, request_id=None, **args):
+        """
+        Trace a request, unless it is not sampled, with a root span.
+        """
+        if not self.enabled:
+            yield None
+            return
+        trace = None
+        if random.random() < self.sample_rate:
+            trace = {"id": request_id or uuid.uuid4().hex[:12], "row": next(self.rows)}
+        token = _current_trace.set(trace)
+        try:
+            with self.span(name, **args):
+                yield trace
+        finally:
+            try:
+                _current_trace.reset(token)
+            except ValueError:
+                # Finished from another context, e.g. a closed generator.
+                _current_trace.set(None)
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Time a block as part of the current request's trace, if any.
+        """
+        trace = _current_trace.get() if self.enabled else None
+        if trace is None:
+            yield
+            return
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._write({
+                "name": name,
+                "cat": "chatgpt",
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (time.perf_counter_ns() - start) / 1000,
+                "pid": self.pid,
+                "tid": trace["row"],
+                "args": {"request_id": trace["id"], **args},
+            })
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
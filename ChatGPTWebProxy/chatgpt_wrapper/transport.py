@@ -0,0 +1,175 @@
+import asyncio
+import codecs
+import json
+import time
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
+
+from chatgpt_wrapper.errors import ChallengeError, StreamTimeoutError
+
+HTTP_TRANSPORT_AVAILABLE = aiohttp is not None
+
+CHALLENGE_MARKERS = (
+    "cf-chl",
+    "challenge-platform",
+    "Just a moment...",
+    "Please stand by, while we are checking your browser...",
+)
+
+class TransportResponse:
+    """
+    A buffered response, offering the parts of Playwright's APIResponse
+    that AsyncChatGPT uses, so both transports are interchangeable.
+    """
+
+    def __init__(self, status, status_text, headers, body):
+        self.status = status
+        self.status_text = status_text
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    async def text(self):
+        return self.body.decode("utf-8", errors="replace")
+
+    async def json(self):
+        return json.loads(self.body)
+
+class BrowserTransport:
+    """
+    Sends API requests through the browser's request context, with its
+    cookies. Conversations are streamed by the page pool.
+    """
+
+    name = "browser"
+
+    def __init__(self, request_context):
+        self.request_context = request_context
+
+    async def request(self, method, url, headers=None, params=None, data=None):
+        return await self.request_context.fetch(url, method=method, headers=headers, params=params, data=data)
+
+    async def close(self):
+        pass
+
+class HttpTransport:
+    """
+    Sends API requests and streams conversations over pooled keep-alive
+    connections, without involving the browser.
+
+    Requests carry the browser's user agent and cookies, which are synced
+    again whenever the session is refreshed. If upstream answers with a
+    browser challenge a ChallengeError is raised and the transport stays
+    unavailable for challenge_cooldown seconds, so the caller falls back
+    to the browser in the meantime.
+
+    Requires aiohttp, see HTTP_TRANSPORT_AVAILABLE.
+    """
+
+    name = "http"
+
+    def __init__(self, base_url, user_agent, pool_size=10, challenge_cooldown=300):
+        self.base_url = base_url
+        self.challenge_cooldown = challenge_cooldown
+        self.challenged_until = 0
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=60),
+            headers={"User-Agent": user_agent},
+        )
+
+    def available(self):
+        return time.monotonic() >= self.challenged_until
+
+    def update_cookies(self, cookies):
+        """
+        Take over cookies exported from the browser context.
+        """
+        self.session.cookie_jar.update_cookies(
+            {cookie["name"]: cookie["value"] for cookie in cookies},
+            URL(self.base_url),
+        )
+
+    def _check_challenge(self, status, headers, body):
+        if status not in (403, 503):
+            return
+        text = body.decode("utf-8", errors="replace")
+        if headers.get("cf-mitigated") == "challenge" or any(marker in text for marker in CHALLENGE_MARKERS):
+            self.challenged_until = time.monotonic() + self.challenge_cooldown
+            raise ChallengeError(f"Browser challenge on direct request ({status})")
+
+    async def request(self, method, url, headers=None, params=None, data=None):
+        async with self.session.request(method, url, headers=headers, params=params, json=data) as response:
+            body = await response.read()
+            self._check_challenge(response.status, response.headers, body)
+            return TransportResponse(response.status, response.reason, dict(response.headers), body)
+
+    async def stream(self, url, data, headers, read_timeout):
+        """
+        POST a conversation request and yield its events as (kind, data),
+        the same events the in-page stream emits: 'meta' with the ids when
+        they change, 'delta' with the new part of the message, and 'error'.
+        """
+        headers = dict(headers, Accept="text/event-stream")
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=read_timeout)
+        try:
+            async with self.session.post(url, json=data, headers=headers, timeout=timeout) as response:
+                if response.status >= 400:
+                    body = await response.read()
+                    self._check_challenge(response.status, response.headers, body)
+                    yield "error", json.dumps({
+                        "status": response.status,
+                        "retry_after": response.headers.get("Retry-After"),
+                        "message": body.decode("utf-8", errors="replace"),
+                    })
+                    return
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                buffer = ""
+                data_lines = []
+                last_message = ""
+                last_meta = None
+                async for chunk in response.content.iter_any():
+                    buffer += decoder.decode(chunk)
+                    lines = buffer.split("\n")
+                    buffer = lines.pop()
+                    for line in lines:
+                        line = line.rstrip("\r")
+                        if line.startswith("data:"):
+                            data_lines.append(line[6:] if line.startswith("data: ") else line[5:])
+                            continue
+                        if line != "":
+                            continue
+                        event_data = "\n".join(data_lines)
+                        data_lines = []
+                        if event_data == "" or event_data == "[DONE]":
+                            continue
+                        try:
+                            event = json.loads(event_data)
+                            meta = json.dumps({
+                                "conversation_id": event["conversation_id"],
+                                "message_id": event["message"]["id"],
+                            })
+                            message = "\n".join(event["message"]["content"]["parts"])
+                        except (ValueError, KeyError, TypeError) as e:
+                            yield "error", json.dumps({"status": None, "decode": True, "message": str(e)})
+                            return
+                        if meta != last_meta:
+                            last_meta = meta
+                            yield "meta", meta
+                        delta = message[len(last_message):]
+                        last_message = message
+                        if delta:
+                            yield "delta", delta
+        except asyncio.TimeoutError:
+            raise StreamTimeoutError(f"No stream event received in {read_timeout} seconds")
+        except aiohttp.ClientError as e:
+            yield "error", json.dumps({"status": None, "message": str(e)})
+
+    async def close(self):
+        await self.session.close()
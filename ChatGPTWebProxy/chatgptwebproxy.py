@@ -1,51 +1,449 @@
-from chatgpt_wrapper import ChatGPT
+from chatgpt_wrapper import Conversation
+from chatgpt_wrapper.admission import FairQueue, TokenBucket, drain_time
+from chatgpt_wrapper.cache import ResponseCache, normalize_prompt
 from chatgpt_wrapper.config import Config
-import socket
-import atexit
+from chatgpt_wrapper.errors import DeadlineExceededError, GenerationInterruptedError, OverloadedError, ResponseDecodeError, SessionUnusableError, UpstreamError
+from chatgpt_wrapper.logger import Logger
+from chatgpt_wrapper.metrics import serve_metrics
+import chatgpt_wrapper.metrics as metrics
+from chatgpt_wrapper.retry import RetryPolicy
+from chatgpt_wrapper.tracing import get_tracer
+from chatgpt_wrapper.supervisor import ChatGPTSupervisor
+import asyncio
+import contextvars
+import json
+import math
 
-config = None
-gpt = None
+LEGACY_READ_SIZE = 2048
+READ_SIZE = 65536
 
-def exit_handler():
-    if(gpt != None):
-        gpt.delete_conversation()
-        print("GPT Conversation Deleted...")
-atexit.register(exit_handler)
+# Framed protocol: a client opens with the hello line, after which both
+# sides exchange newline-delimited JSON objects tagged with a request id.
+# Anything else is treated as a legacy one-shot request.
+PROTOCOL_VERSION = 1
+PROTOCOL_HELLO = b"MINEGPT/%d\n" % PROTOCOL_VERSION
 
-def request(prompt,gpt):
-    #config.set('browser.debug', True)
-    response1 = gpt.ask(prompt)
-    return response1
+class ProxyRequest:
+    """
+    A prompt waiting in the proxy queue, optionally rendered through a
+    server-side prompt template. Untemplated prompts from a named client
+    continue that client's own conversation.
 
-if __name__ == '__main__':
-    config = Config()
-    gpt = ChatGPT(config)
+    The request must be answered within timeout seconds, and is abandoned
+    once every caller waiting for it has gone away.
+    """
 
-    s = socket.socket()
-    s.bind(("127.0.0.1",23484))
-    s.listen(1)
+    def __init__(self, prompt, template=None, client=None, timeout=None):
+        loop = asyncio.get_running_loop()
+        self.prompt = prompt
+        self.template = template
+        self.client = client
+        self.queued = loop.time()
+        self.deadline = self.queued + timeout if timeout else None
+        self.future = loop.create_future()
+        # Generated in the context of the caller, so its trace follows it.
+        self.context = contextvars.copy_context()
+        self.task = None
+        self.waiters = 0
 
-    print("GPT Web Proxy Server Listening")
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - asyncio.get_running_loop().time()
 
-    lastPrompt = ""
+    def expired(self):
+        return self.deadline is not None and self.remaining() <= 0
 
-    while True:
-        conn, addr = s.accept()
-        with conn:
-            recv = conn.recv(2048).decode()
-            print("Request: "+recv)
-            response = ""
-            for attempt in range(3):
+class GPTProxyServer:
+    """
+    Socket server the MineGPT plugin talks to.
+
+    Connections are accepted on the same event loop that drives
+    AsyncChatGPT, so any number of players can be connected and waiting
+    while generations are scheduled from a bounded request queue. The queue
+    is fair between players, and requests leave it no faster than the
+    upstream rate limit allows.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.log = Logger(self.__class__.__name__, self.config)
+        self.tracer = get_tracer(self.config)
+        self.supervisor = ChatGPTSupervisor(self.config)
+        self.server = None
+        self.metrics_server = None
+        self.workers = []
+        self.max_connections = self.config.get('proxy.max_connections')
+        self.connections = 0
+        self.queue = FairQueue(
+            self.config.get('admission.queue_size'),
+            self.config.get('admission.max_per_client'),
+            self.config.get('admission.weights'),
+        )
+        self.bucket = TokenBucket(self.config.get('admission.rate'), self.config.get('admission.burst'))
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.queue), queue="proxy")
+        self.cache = ResponseCache(self.config)
+        self.request_timeout = self.config.get('proxy.request_timeout')
+        self.retry = RetryPolicy(self.config)
+        self.templates = self.config.get('proxy.templates')
+        self.primed = {}
+        self.inflight = {}
+        self.priming_lock = asyncio.Lock()
+
+    @property
+    def gpt(self):
+        return self.supervisor.active
+
+    async def start(self):
+        await self.supervisor.start()
+        # One worker per browser page, so generations run in parallel
+        # up to the size of the page pool.
+        self.workers = [asyncio.create_task(self._process_queue()) for _ in self.gpt.pages]
+        self.server = await asyncio.start_server(
+            self.handle_connection,
+            self.config.get('proxy.host'),
+            self.config.get('proxy.port'),
+            backlog=self.max_connections,
+        )
+        print("GPT Web Proxy Server Listening")
+        if self.config.get('proxy.metrics.enabled'):
+            self.metrics_server = await serve_metrics(
+                self.config.get('proxy.metrics.host'),
+                self.config.get('proxy.metrics.port'),
+            )
+            print("Metrics available at /metrics on port %d" % self.config.get('proxy.metrics.port'))
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def cleanup(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        for worker in self.workers:
+            worker.cancel()
+        if self.gpt is not None:
+            await self.gpt.delete_conversation()
+            for conversation in list(self.primed.values()) + self.gpt.sessions.conversations():
+                if conversation.conversation_id:
+                    await self.gpt.delete_conversation(conversation.conversation_id)
+            print("GPT Conversation Deleted...")
+        await self.supervisor.cleanup()
+        self.cache.close()
+        self.tracer.close()
+
+    def render_template(self, template, prompt):
+        template = self.templates[template]
+        return template['preamble'] + template['prompt'].format(prompt=prompt)
+
+    async def request(self, prompt, bypass_cache=False, template=None, client=None, timeout=None):
+        """
+        Queue a prompt for generation and wait for the response.
+
+        With a template, only the user portion is sent, branching from the
+        template's primed conversation. Templated prompts do not depend on
+        earlier ones, their cached responses are returned without touching
+        the browser unless bypass_cache is set. Untemplated prompts continue
+        the client's conversation and are never cached. Identical
+        prompts arriving while one is queued or generating share its result.
+
+        The request is dropped, or its generation interrupted, once it is
+        past its deadline (timeout seconds, proxy.request_timeout by
+        default) or when every caller waiting for it has been cancelled.
+
+        Raises OverloadedError if the queue, or the client's share of it, is
+        full, DeadlineExceededError past the deadline, and the last error if
+        every attempt at generating failed. Failed responses are never
+        cached.
+        """
+        cache_prompt = self.render_template(template, prompt) if template else prompt
+        if template and not bypass_cache:
+            response = self.cache.get(cache_prompt)
+            if response is not None:
+                self.log.info("Serving response from cache")
+                return response
+        key = (normalize_prompt(cache_prompt), template, None if template else client)
+        request = self.inflight.get(key)
+        if request is not None:
+            self.log.info("Attaching to in-flight request for the same prompt")
+        else:
+            request = ProxyRequest(prompt, template, client, timeout or self.request_timeout)
+            if not self.queue.put_nowait(request, client):
+                self.log.warning(f"Request queue is full, rejecting request from {client or 'anonymous client'}")
+                metrics.REJECTIONS.inc()
+                raise OverloadedError(
+                    "Too many requests queued, please try again later",
+                    retry_after=drain_time(len(self.queue), self.bucket.rate),
+                )
+            self.inflight[key] = request
+
+            def forget(_future):
+                if self.inflight.get(key) is request:
+                    del self.inflight[key]
+
+            request.future.add_done_callback(forget)
+        response = await self._wait(request)
+        if template:
+            self.cache.set(cache_prompt, response)
+        return response
+
+    async def _wait(self, request):
+        request.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(request.future), request.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceededError("Request was not answered before its deadline")
+        finally:
+            request.waiters -= 1
+            if request.waiters == 0 and not request.future.done():
+                self._abandon(request)
+
+    def _abandon(self, request):
+        """
+        Nobody is waiting for the request anymore. A queued request is
+        skipped by the workers, a running one is cancelled, which
+        interrupts its stream in the browser.
+        """
+        self.log.info(f"Abandoning request from {request.client or 'anonymous client'}")
+        request.future.cancel()
+        if request.task is not None:
+            request.task.cancel()
+
+    async def _primed_conversation(self, template):
+        """
+        Return the conversation primed with the template's preamble,
+        sending the preamble the first time the template is used.
+        """
+        async with self.priming_lock:
+            if template not in self.primed:
+                self.log.info(f"Priming conversation for template {template}")
+                conversation = Conversation()
+                await self.gpt.ask(self.templates[template]['preamble'], conversation)
+                self.primed[template] = conversation
+        return self.primed[template]
+
+    async def _recycle(self, failed_gpt):
+        self.log.info("Recycling ChatGPT browser")
+        try:
+            await failed_gpt.delete_conversation()
+        except Exception:
+            self.log.error("Failed to delete conversation of old ChatGPT browser")
+        gpt = await self.supervisor.swap(failed_gpt)
+        if gpt is not failed_gpt:
+            gpt.new_conversation()
+
+    async def _generate(self, request):
+        with self.tracer.span("proxy.generate"):
+            return await self.retry.run(lambda: self._attempt(request))
+
+    async def _attempt(self, request):
+        """
+        Make one attempt at generating the response. Errors that point at
+        the browser recycle it before the error is raised; upstream and
+        session errors leave it alone, another browser would fail the same.
+        """
+        gpt = self.gpt
+        try:
+            if request.template:
+                primed = await self._primed_conversation(request.template)
+                prompt = self.templates[request.template]['prompt'].format(prompt=request.prompt)
                 try:
+                    return await gpt.ask(prompt, primed.branch())
+                except UpstreamError as e:
+                    if not e.retryable and self.primed.get(request.template) is primed:
+                        # The primed conversation may be gone upstream, prime
+                        # a new one for the next request.
+                        self.log.warning(f"Dropping primed conversation for template {request.template}")
+                        del self.primed[request.template]
+                    raise
+            conversation = gpt.get_session(request.client)
+            if request.prompt == conversation.last_prompt:
+                if conversation.conversation_id:
+                    await gpt.delete_conversation(conversation.conversation_id)
+                conversation = gpt.new_conversation(request.client)
+            response = await gpt.ask(request.prompt, conversation)
+            conversation.last_prompt = request.prompt
+            return response
+        except (UpstreamError, SessionUnusableError, ResponseDecodeError, GenerationInterruptedError):
+            raise
+        except Exception as e:
+            self.log.error(f"Request attempt failed: {e}")
+            try:
+                await self._recycle(gpt)
+            except Exception:
+                self.log.error("Failed to recycle ChatGPT browser")
+            raise
+
+    async def _process_queue(self):
+        while True:
+            request = await self.queue.get()
+            if request.future.done():
+                continue
+            await self.bucket.acquire()
+            if request.future.done():
+                continue
+            if request.expired():
+                self.log.warning("Dropping request that expired while queued")
+                request.future.set_exception(DeadlineExceededError("Request expired while queued"))
+                continue
+            metrics.QUEUE_WAIT_SECONDS.observe(asyncio.get_running_loop().time() - request.queued, queue="proxy")
+            request.task = request.context.run(asyncio.create_task, self._generate(request))
+            try:
+                await asyncio.wait({request.task})
+            except asyncio.CancelledError:
+                request.task.cancel()
+                raise
+            if request.future.done() or request.task.cancelled():
+                continue
+            if request.task.exception() is not None:
+                request.future.set_exception(request.task.exception())
+            else:
+                request.future.set_result(request.task.result())
+
+    async def _read_frames(self, reader, buffered):
+        while True:
+            while b"\n" in buffered:
+                line, buffered = buffered.split(b"\n", 1)
+                if line.strip():
+                    yield line
+            chunk = await reader.read(READ_SIZE)
+            if not chunk:
+                return
+            buffered += chunk
 
-                    if(recv == lastPrompt):
-                        gpt.delete_conversation()
-                        gpt = ChatGPT(config)
+    async def _write_frame(self, writer, write_lock, frame):
+        async with write_lock:
+            writer.write(json.dumps(frame).encode() + b"\n")
+            await writer.drain()
 
-                    response = request(recv,gpt)
+    async def _handle_frame(self, writer, write_lock, line):
+        request_id = None
+        try:
+            frame = json.loads(line)
+            if not isinstance(frame, dict):
+                raise TypeError("frame must be an object")
+            if isinstance(frame.get("id"), (str, int, float)) and not isinstance(frame["id"], bool):
+                # Echoed in errors from here on, so the client can match them.
+                request_id = frame["id"]
+            else:
+                raise TypeError("id must be a string or a number")
+            prompt = frame["prompt"]
+            bypass_cache = bool(frame.get("bypass_cache", False))
+            template = frame.get("template")
+            client = frame.get("client")
+            timeout = frame.get("timeout")
+            if timeout is not None:
+                timeout = float(timeout)
+                if not math.isfinite(timeout) or timeout <= 0:
+                    raise ValueError("timeout must be a positive number")
+            if not isinstance(prompt, str):
+                raise TypeError("prompt must be a string")
+            if not isinstance(template, (str, type(None))) or not isinstance(client, (str, type(None))):
+                raise TypeError("template and client must be strings")
+        except (ValueError, KeyError, TypeError):
+            await self._write_frame(writer, write_lock, {"v": PROTOCOL_VERSION, "id": request_id, "error": "Malformed request frame"})
+            return
+        if template and template not in self.templates:
+            await self._write_frame(writer, write_lock, {"v": PROTOCOL_VERSION, "id": request_id, "error": f"Unknown template: {template}"})
+            return
+        print("Request: " + prompt)
+        try:
+            with self.tracer.request("proxy.request", frame_id=request_id, client=client, template=template):
+                response = await self.request(prompt, bypass_cache, template, client, timeout)
+        except Exception as e:
+            self.log.error(f"Request failed: {e}")
+            frame = {"v": PROTOCOL_VERSION, "id": request_id, "error": str(e)}
+            if getattr(e, 'retry_after', None):
+                frame["retry_after"] = e.retry_after
+            await self._write_frame(writer, write_lock, frame)
+            return
+        print("Recieved: " + response)
+        await self._write_frame(writer, write_lock, {"v": PROTOCOL_VERSION, "id": request_id, "response": response})
+
+    async def _handle_framed(self, reader, writer, buffered):
+        """
+        Serve a keep-alive connection. Every frame is dispatched as soon as
+        it is read, so several requests can be in flight on one socket and
+        their responses are written back in completion order. Requests still
+        pending when the client disconnects are cancelled.
+        """
+        writer.write(PROTOCOL_HELLO)
+        await writer.drain()
+        write_lock = asyncio.Lock()
+        pending = set()
+        try:
+            async for line in self._read_frames(reader, buffered):
+                task = asyncio.create_task(self._handle_frame(writer, write_lock, line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            if pending:
+                self.log.warning(f"Client disconnected, cancelling {len(pending)} pending requests")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _handle_legacy(self, reader, writer, data):
+        recv = data.decode()
+        print("Request: " + recv)
+        # One-shot clients send nothing more, so the end of the stream means
+        # they have disconnected and the request can be cancelled.
+        request = asyncio.create_task(self.request(recv))
+        disconnect = asyncio.create_task(reader.read(LEGACY_READ_SIZE))
+        await asyncio.wait({request, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+        if not request.done() and disconnect.done() and not disconnect.exception() and not disconnect.result():
+            request.cancel()
+            await asyncio.gather(request, return_exceptions=True)
+            raise ConnectionResetError("Client disconnected")
+        disconnect.cancel()
+        try:
+            response = await request
+        except Exception as e:
+            # One-shot clients cannot be told why, an empty response is
+            # reported to the player as a rate limit.
+            self.log.error(f"Request failed: {e}")
+            response = ""
+        print("Recieved: " + response)
+        writer.write(response.encode())
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        if self.connections >= self.max_connections:
+            self.log.warning("Connection limit reached, refusing connection")
+            writer.close()
+            return
+        self.connections += 1
+        try:
+            data = await reader.read(LEGACY_READ_SIZE)
+            while data and len(data) < len(PROTOCOL_HELLO) and PROTOCOL_HELLO.startswith(data):
+                chunk = await reader.read(LEGACY_READ_SIZE)
+                if not chunk:
                     break
-                except:
-                    pass
-            print("Recieved: "+response)
-            conn.send(response.encode())
-            conn.close()
\ No newline at end of file
+                data += chunk
+            if data.startswith(PROTOCOL_HELLO):
+                await self._handle_framed(reader, writer, data[len(PROTOCOL_HELLO):])
+            elif data:
+                with self.tracer.request("proxy.legacy_request"):
+                    await self._handle_legacy(reader, writer, data)
+        except ConnectionError:
+            self.log.warning("Client disconnected before receiving a response")
+        finally:
+            self.connections -= 1
+            writer.close()
+
+async def main():
+    config = Config()
+    config.load_from_file()
+    proxy = GPTProxyServer(config)
+    try:
+        await proxy.start()
+        await proxy.serve_forever()
+    finally:
+        await proxy.cleanup()
+
+if __name__ == '__main__':
+    asyncio.run(main())
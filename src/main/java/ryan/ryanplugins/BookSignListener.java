@@ -27,7 +27,7 @@ public class BookSignListener implements Listener {
         if(bookMeta.getTitle().startsWith("gpt")) {
             //plugin.getLogger().info("Page: " + bookMeta.getPage(0));
             player.sendMessage(ChatColor.translateAlternateColorCodes('&',"GPT Processing"));
-            String[] commands = GPTCommand.generateCommands(bookMeta.getPages().get(0));
+            String[] commands = GPTCommand.generateCommands(bookMeta.getPages().get(0), false, player.getName());
             if(commands.length > 0) {
                 player.sendMessage(ChatColor.translateAlternateColorCodes('&', "&6" + Arrays.toString(commands)));
             } else {
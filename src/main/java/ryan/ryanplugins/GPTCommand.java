@@ -48,7 +48,17 @@ public class GPTCommand implements CommandExecutor {
 
             }
 
-            String response = Arrays.toString(generateCommands(ArrayToString(args)));
+            boolean bypassCache = false;
+            if(args[0].equals("nocache")) {
+                if(!player.isOp()) {
+                    player.sendMessage(ChatColor.translateAlternateColorCodes('&', "Only operators can bypass the cache."));
+                    return true;
+                }
+                bypassCache = true;
+                args = Arrays.copyOfRange(args, 1, args.length);
+            }
+
+            String response = Arrays.toString(generateCommands(ArrayToString(args), bypassCache, player.getName()));
             player.sendMessage(ChatColor.translateAlternateColorCodes('&',response));
 
             return true;
@@ -59,9 +69,20 @@ public class GPTCommand implements CommandExecutor {
     }
 
     public static String[] generateCommands(String prompt) {
-        String totalPrompt = "You are an expert in writing minecraft commands. The user gives you a prompt and you turn it into minecraft commands for minecraft the game. Don't give any details or explanation about the code you've written, only give the commands. Format it in a numbered list. These commands will be chained into commands blocks and be executed every tick. Prompt: "+prompt+". Commands:";
+        return generateCommands(prompt, false, null);
+    }
+
+    // Name of the matching server-side template in the local proxy, which
+    // primes the preamble once so only the player's prompt is sent.
+    private static final String PROMPT_TEMPLATE = "minecraft";
+
+    public static String buildPrompt(String prompt) {
+        return "You are an expert in writing minecraft commands. The user gives you a prompt and you turn it into minecraft commands for minecraft the game. Don't give any details or explanation about the code you've written, only give the commands. Format it in a numbered list. These commands will be chained into commands blocks and be executed every tick. Prompt: "+prompt+". Commands:";
+    }
+
+    public static String[] generateCommands(String prompt, boolean bypassCache, String client) {
         try {
-            String response = generateResponse(totalPrompt);
+            String response = generateResponse(prompt, bypassCache, client);
             String[] commands = splitter(response);
 
 
@@ -76,10 +97,15 @@ public class GPTCommand implements CommandExecutor {
     private static boolean useLocal = true; //If you have a chatGPT wrapper locally setup.
 
     public static String generateResponse(String prompt) throws IOException {
+        return generateResponse(prompt, false, null);
+    }
+
+    public static String generateResponse(String prompt, boolean bypassCache, String client) throws IOException {
 
         if(useLocal) {
-            return RequestGPTFromLocal(prompt);
+            return RequestGPTFromLocal(prompt, bypassCache, client);
         }
+        prompt = buildPrompt(prompt);
 
         // Set up the HTTP connection
         URL url = new URL(API_URL);
@@ -210,9 +236,33 @@ public class GPTCommand implements CommandExecutor {
     }
 
 
+    private static final String LOCAL_HOST = "127.0.0.1";
+    private static final int LOCAL_PORT = 23484;
+    private static final ProxyConnection localConnection = new ProxyConnection(LOCAL_HOST, LOCAL_PORT);
+    private static boolean useFramedProtocol = true; //Falls back to one-shot requests for older proxies.
+
     public static String RequestGPTFromLocal(String prompt) {
-        String hostName = "127.0.0.1";
-        int portNumber = 23484;
+        return RequestGPTFromLocal(prompt, false, null);
+    }
+
+    public static String RequestGPTFromLocal(String prompt, boolean bypassCache, String client) {
+        if(useFramedProtocol) {
+            try {
+                return localConnection.request(prompt, bypassCache, PROMPT_TEMPLATE, client);
+            } catch (ProxyConnection.UnsupportedProtocolException e) {
+                System.err.println(e.getMessage() + ", falling back to one-shot requests");
+                useFramedProtocol = false;
+            } catch (IOException e) {
+                System.err.println("Framed request to " + LOCAL_HOST + " failed: " + e.getMessage());
+                return "";
+            }
+        }
+        return RequestGPTFromLocalOneShot(buildPrompt(prompt));
+    }
+
+    public static String RequestGPTFromLocalOneShot(String prompt) {
+        String hostName = LOCAL_HOST;
+        int portNumber = LOCAL_PORT;
 
         try (Socket socket = new Socket(hostName, portNumber);
              PrintWriter out = new PrintWriter(socket.getOutputStream(), true);
@@ -0,0 +1,165 @@
+package ryan.ryanplugins;
+
+import com.google.gson.JsonElement;
+import com.google.gson.JsonObject;
+import com.google.gson.JsonParser;
+
+import java.io.BufferedReader;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
+import java.io.Writer;
+import java.net.Socket;
+import java.nio.charset.StandardCharsets;
+import java.util.Map;
+import java.util.concurrent.CompletableFuture;
+import java.util.concurrent.ConcurrentHashMap;
+import java.util.concurrent.ExecutionException;
+import java.util.concurrent.TimeUnit;
+import java.util.concurrent.TimeoutException;
+import java.util.concurrent.atomic.AtomicLong;
+
+// Keep-alive connection to the local proxy using the framed protocol.
+// Requests are written as one JSON object per line and tagged with an id,
+// so several can be in flight on the socket at once.
+public class ProxyConnection {
+
+    public static final String PROTOCOL_HELLO = "MINEGPT/1";
+    private static final long RESPONSE_TIMEOUT_SECONDS = 300;
+
+    private final String hostName;
+    private final int portNumber;
+
+    private Socket socket;
+    private Writer out;
+    private final Map<String, CompletableFuture<String>> pending = new ConcurrentHashMap<>();
+    private final AtomicLong nextId = new AtomicLong();
+
+    public ProxyConnection(String hostName, int portNumber) {
+        this.hostName = hostName;
+        this.portNumber = portNumber;
+    }
+
+    private synchronized void ensureConnected() throws IOException {
+        if(socket != null && !socket.isClosed()) {
+            return;
+        }
+        Socket newSocket = new Socket(hostName, portNumber);
+        BufferedReader in = new BufferedReader(new InputStreamReader(newSocket.getInputStream(), StandardCharsets.UTF_8));
+        Writer newOut = new OutputStreamWriter(newSocket.getOutputStream(), StandardCharsets.UTF_8);
+        newOut.write(PROTOCOL_HELLO + "\n");
+        newOut.flush();
+
+        String hello = in.readLine();
+        if(!PROTOCOL_HELLO.equals(hello)) {
+            newSocket.close();
+            throw new UnsupportedProtocolException("Proxy does not speak " + PROTOCOL_HELLO);
+        }
+
+        socket = newSocket;
+        out = newOut;
+        Thread readerThread = new Thread(() -> readLoop(newSocket, in), "MineGPT-ProxyReader");
+        readerThread.setDaemon(true);
+        readerThread.start();
+    }
+
+    private void readLoop(Socket readSocket, BufferedReader in) {
+        try {
+            String line;
+            while((line = in.readLine()) != null) {
+                if(line.trim().isEmpty()) {continue;}
+                JsonObject frame = JsonParser.parseString(line).getAsJsonObject();
+                JsonElement id = frame.get("id");
+                if(id == null || id.isJsonNull()) {
+                    System.err.println("Proxy error: " + frame);
+                    continue;
+                }
+                CompletableFuture<String> future = pending.remove(id.getAsString());
+                if(future == null) {continue;}
+                if(frame.has("response")) {
+                    future.complete(frame.get("response").getAsString());
+                } else {
+                    String error = frame.has("error") ? frame.get("error").getAsString() : "Empty response frame";
+                    if(frame.has("retry_after")) {
+                        error += " (retry after " + frame.get("retry_after").getAsLong() + "s)";
+                    }
+                    future.completeExceptionally(new IOException(error));
+                }
+            }
+        } catch (Exception e) {
+            System.err.println("Lost connection to proxy: " + e);
+        } finally {
+            disconnect(readSocket);
+        }
+    }
+
+    private synchronized void disconnect(Socket readSocket) {
+        try {
+            readSocket.close();
+        } catch (IOException ignored) {
+        }
+        if(socket == readSocket) {
+            socket = null;
+            out = null;
+        }
+        for(CompletableFuture<String> future : pending.values()) {
+            future.completeExceptionally(new IOException("Connection to proxy closed"));
+        }
+        pending.clear();
+    }
+
+    public String request(String prompt) throws IOException {
+        return request(prompt, false);
+    }
+
+    public String request(String prompt, boolean bypassCache) throws IOException {
+        return request(prompt, bypassCache, null, null);
+    }
+
+    public String request(String prompt, boolean bypassCache, String template, String client) throws IOException {
+        String id = Long.toString(nextId.incrementAndGet());
+        CompletableFuture<String> future = new CompletableFuture<>();
+
+        JsonObject frame = new JsonObject();
+        frame.addProperty("id", id);
+        frame.addProperty("prompt", prompt);
+        // The proxy drops the request once we have stopped waiting for it.
+        frame.addProperty("timeout", RESPONSE_TIMEOUT_SECONDS);
+        if(bypassCache) {
+            frame.addProperty("bypass_cache", true);
+        }
+        if(template != null) {
+            frame.addProperty("template", template);
+        }
+        if(client != null) {
+            frame.addProperty("client", client);
+        }
+
+        synchronized (this) {
+            ensureConnected();
+            pending.put(id, future);
+            out.write(frame.toString() + "\n");
+            out.flush();
+        }
+
+        try {
+            return future.get(RESPONSE_TIMEOUT_SECONDS, TimeUnit.SECONDS);
+        } catch (InterruptedException e) {
+            Thread.currentThread().interrupt();
+            throw new IOException("Interrupted waiting for proxy", e);
+        } catch (ExecutionException e) {
+            throw new IOException(e.getCause());
+        } catch (TimeoutException e) {
+            throw new IOException("Timed out waiting for proxy", e);
+        } finally {
+            pending.remove(id);
+        }
+    }
+
+    public static class UnsupportedProtocolException extends IOException {
+        public UnsupportedProtocolException(String message) {
+            super(message);
+        }
+    }
+
+}